@@ -0,0 +1,47 @@
+"""
+Compare loading a file, making a substitution, and saving it in text mode,
+with a few encodings and error handlers, and in binary mode, where nothing
+is decoded.
+
+    python benchmarks/bench_bytes.py [lines]
+"""
+import os
+import sys
+import tempfile
+import timeit
+
+import editor
+
+
+# -----------------------------------------------------------------------------
+def main(args):
+    """
+    Time a load, sub(), and save of a *lines* line file in each mode
+    """
+    nlines = int(args[0]) if len(args) > 0 else 1000000
+    fd, src = tempfile.mkstemp()
+    with os.fdopen(fd, 'wb') as f:
+        f.writelines("line {0} café with some words {1}\n".format(
+            _, _ * 7).encode('utf-8') for _ in range(nlines))
+    dst = src + ".out"
+
+    modes = [("utf-8", {'encoding': 'utf-8'}, "words", "WORDS"),
+             ("utf-8 surrogates", {'encoding': 'utf-8',
+                                   'errors': 'surrogateescape'},
+              "words", "WORDS"),
+             ("latin-1", {'encoding': 'latin-1'}, "words", "WORDS"),
+             ("binary", {'binary': True}, b"words", b"WORDS")]
+    for storage in ['list', 'mmap']:
+        for name, kwargs, rgx, repl in modes:
+            def run():
+                q = editor.editor(src, storage=storage, **kwargs)
+                q.sub(rgx, repl)
+                q.quit(filepath=dst)
+            best = min(timeit.repeat(run, number=1, repeat=3))
+            print("{0:6s} {1:18s} {2:8.3f}s".format(storage, name, best))
+    os.unlink(src)
+    os.unlink(dst)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
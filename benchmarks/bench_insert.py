@@ -0,0 +1,40 @@
+"""
+Compare inserting and deleting lines in the middle of a large buffer held
+as a plain list against editor.lines.ChunkedLines.
+
+    python benchmarks/bench_insert.py [lines] [edits]
+"""
+import random
+import sys
+import timeit
+
+from editor.lines import ChunkedLines
+
+
+# -----------------------------------------------------------------------------
+def main(args):
+    """
+    Time *edits* inserts followed by *edits* deletes at random positions in
+    a buffer of *lines* lines, for each container
+    """
+    nlines = int(args[0]) if len(args) > 0 else 2000000
+    nedits = int(args[1]) if len(args) > 1 else 5000
+    lines = ["line {0}".format(_) for _ in range(nlines)]
+    rand = random.Random(0)
+    spots = [rand.randrange(nlines) for _ in range(nedits)]
+
+    for kind in [list, ChunkedLines]:
+        buf = kind(lines)
+
+        def edit():
+            for spot in spots:
+                buf.insert(spot, "new line")
+            for spot in spots:
+                del buf[spot]
+
+        best = min(timeit.repeat(edit, number=1, repeat=3))
+        print("{0:16s} {1:8.3f}s".format(kind.__name__, best))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
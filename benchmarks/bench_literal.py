@@ -0,0 +1,57 @@
+"""
+Compare editor.sub() and editor.delete() on literal patterns against the
+per-line re.sub()/re.search() loop they used to run.
+
+    python benchmarks/bench_literal.py [lines]
+"""
+import re
+import sys
+import timeit
+
+import editor
+
+
+# -----------------------------------------------------------------------------
+def main(args):
+    """
+    Time each variant on a buffer of generated lines, one line in ten of
+    which contains the needle
+    """
+    nlines = int(args[0]) if args else 1000000
+    old, new = "host1.example.com", "host2.example.com"
+    lines = ["line {0} {1} port 8080".format(_, old if _ % 10 == 0 else
+                                             "localhost")
+             for _ in range(nlines)]
+
+    def regex_sub():
+        return [re.sub(old, new, line, 0) for line in lines]
+
+    def regex_delete():
+        return [line for line in lines if not re.search(old, line)]
+
+    def editor_op(name, literal):
+        def run():
+            q = editor.editor(content=lines[:])
+            getattr(q, name)(*((old, new) if name == 'sub' else (old,)),
+                             literal=literal)
+        return run
+
+    report("sub: re.sub per line", regex_sub)
+    report("sub: editor, regex", editor_op('sub', False))
+    report("sub: editor, literal", editor_op('sub', True))
+    report("delete: re.search per line", regex_delete)
+    report("delete: editor, regex", editor_op('delete', False))
+    report("delete: editor, literal", editor_op('delete', True))
+
+
+# -----------------------------------------------------------------------------
+def report(label, func, repeat=5):
+    """
+    Print the best of *repeat* runs of *func*
+    """
+    best = min(timeit.repeat(func, number=1, repeat=repeat))
+    print("{0:32s} {1:8.3f}s".format(label, best))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,56 @@
+"""
+Compare loading a file by readlines() and rstrip() on each line, as
+editor.contents() used to, with the block reads editor uses now, in text
+and binary mode, for LF and CR-LF files.
+
+    python benchmarks/bench_load.py [lines]
+"""
+import os
+import sys
+import tempfile
+import timeit
+
+import editor
+
+
+# -----------------------------------------------------------------------------
+def readlines(path, binary):
+    """
+    Load *path* the old way
+    """
+    if binary:
+        with open(path, 'rb') as f:
+            return [x.rstrip(b"\r\n") for x in f.readlines()]
+    with open(path, 'r') as f:
+        return [x.rstrip("\r\n") for x in f.readlines()]
+
+
+# -----------------------------------------------------------------------------
+def main(args):
+    """
+    Time loading a *lines* line file each way and report the best of three
+    """
+    nlines = int(args[0]) if len(args) > 0 else 10000000
+    fd, src = tempfile.mkstemp()
+    os.close(fd)
+    for nl in ["\n", "\r\n"]:
+        with open(src, 'w', newline='') as f:
+            f.writelines("line {0} with some words {1}{2}".format(
+                _, _ * 7, nl) for _ in range(nlines))
+        for binary in [False, True]:
+            def old():
+                readlines(src, binary)
+
+            def new():
+                editor.editor(src, binary=binary)
+
+            for name, func in [("readlines", old), ("editor", new)]:
+                best = min(timeit.repeat(func, number=1, repeat=3))
+                print("{0:4s} {1:6s} {2:10s} {3:8.3f}s".format(
+                    repr(nl)[1:-1], "binary" if binary else "text", name,
+                    best))
+    os.unlink(src)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,49 @@
+"""
+Compare editor.sub() with a costly regex run serially and with a pool of
+worker processes, on the buffer and in stream mode.
+
+    python benchmarks/bench_parallel.py [lines] [workers]
+"""
+import os
+import sys
+import tempfile
+import timeit
+
+import editor
+
+
+# -----------------------------------------------------------------------------
+def main(args):
+    """
+    Time a backreferencing substitution over *lines* lines with 1 worker
+    and with *workers* of them
+    """
+    nlines = int(args[0]) if len(args) > 0 else 1000000
+    nworkers = int(args[1]) if len(args) > 1 else os.cpu_count()
+    lines = ["line {0} with some words and numbers {1} abcdef".format(_, _ * 7)
+             for _ in range(nlines)]
+    rgx, repl = r"(\w+)\s+(\d+)\s+(\w+)$", r"\3 \2 \1"
+    fd, src = tempfile.mkstemp()
+    with os.fdopen(fd, 'w') as f:
+        f.writelines(x + "\n" for x in lines)
+
+    for workers in [None, nworkers]:
+        def buffered():
+            q = editor.editor(content=list(lines))
+            q.sub(rgx, repl, workers=workers)
+
+        def streamed():
+            q = editor.editor(src, stream=True)
+            q.sub(rgx, repl, workers=workers)
+            q.quit(filepath=src + ".out")
+
+        for name, func in [("buffer", buffered), ("stream", streamed)]:
+            best = min(timeit.repeat(func, number=1, repeat=3))
+            print("{0:8s} workers={1:<4} {2:8.3f}s".format(
+                name, workers or 1, best))
+    os.unlink(src)
+    os.unlink(src + ".out")
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,50 @@
+"""
+Compare saving a buffer by writelines() of a list holding every line plus
+its terminator, as editor.quit() used to, with the block writes it does
+now, atomically and in place, reporting time and peak traced memory.
+
+    python benchmarks/bench_save.py [lines]
+"""
+import os
+import sys
+import tempfile
+import timeit
+import tracemalloc
+
+import editor
+
+
+# -----------------------------------------------------------------------------
+def main(args):
+    """
+    Time saving a *lines* line buffer each way and measure its memory peak
+    """
+    nlines = int(args[0]) if len(args) > 0 else 1000000
+    lines = ["line {0} with some words {1}".format(_, _ * 7)
+             for _ in range(nlines)]
+    fd, dst = tempfile.mkstemp()
+    os.close(fd)
+
+    def old():
+        with open(dst, 'w') as out:
+            out.writelines([x + "\n" for x in lines])
+
+    def save(atomic):
+        q = editor.editor(content=lines, atomic=atomic)
+        q.quit(filepath=dst, backup=lambda ext: None)
+
+    for name, func in [("writelines", old),
+                       ("atomic", lambda: save(True)),
+                       ("in place", lambda: save(False))]:
+        best = min(timeit.repeat(func, number=1, repeat=3))
+        tracemalloc.start()
+        func()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print("{0:12s} {1:8.3f}s {2:10.1f}MiB".format(name, best,
+                                                      peak / (1 << 20)))
+    os.unlink(dst)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,56 @@
+"""
+Compare checkpointing a buffer with list(q.buffer), as scripts trying
+speculative edits had to, with snapshot() for each storage, timing the
+checkpoint, a sub() that changes a few lines, diff(), and restore(), and
+measuring the memory the checkpoint holds.
+
+    python benchmarks/bench_snapshot.py [lines] [changed]
+"""
+import sys
+import time
+import timeit
+import tracemalloc
+
+import editor
+
+
+# -----------------------------------------------------------------------------
+def main(args):
+    """
+    Checkpoint a *lines* line buffer, change *changed* lines of it, and
+    report what each step costs
+    """
+    nlines = int(args[0]) if len(args) > 0 else 10000000
+    changed = int(args[1]) if len(args) > 1 else 10
+    step = max(1, nlines // changed)
+    lines = ["{0} {1} with some words".format(
+        "hit" if _ % step else "row", _) for _ in range(nlines)]
+
+    for storage, take in [("list", lambda q: list(q.buffer)),
+                          ("list", editor.editor.snapshot),
+                          ("chunked", editor.editor.snapshot),
+                          ("compact", editor.editor.snapshot)]:
+        q = editor.editor(content=lines[:], storage=storage)
+        took = min(timeit.repeat(lambda: take(q), number=1, repeat=3))
+        tracemalloc.start()
+        snap = take(q)
+        held, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        times = [time.perf_counter()]
+        q.sub("row", "ROW")
+        times.append(time.perf_counter())
+        ranges = q.diff(snap)
+        times.append(time.perf_counter())
+        q.restore(snap)
+        times.append(time.perf_counter())
+        assert len(ranges) == changed and q.buffer == lines
+        name = storage + (" copy" if take is not editor.editor.snapshot
+                          else "")
+        print("{0:12s} snapshot {1:8.4f}s {2:9.3f}MiB  sub {3:7.3f}s  "
+              "diff {4:7.3f}s  restore {5:7.4f}s".format(
+                  name, took, held / (1 << 20), times[1] - times[0],
+                  times[2] - times[1], times[3] - times[2]))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,34 @@
+"""
+Measure how long the command line interface takes to start, edit a one
+line standard input, and exit, next to a bare interpreter.
+
+    python benchmarks/bench_startup.py [runs]
+"""
+import os
+import subprocess
+import sys
+import timeit
+
+
+# -----------------------------------------------------------------------------
+def main(args):
+    """
+    Time *runs* runs of each command and report the mean
+    """
+    runs = int(args[0]) if len(args) > 0 else 50
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ, PYTHONPATH=root)
+    commands = [("python", [sys.executable, "-c", "pass"]),
+                ("import editor", [sys.executable, "-c", "import editor"]),
+                ("python -m editor", [sys.executable, "-m", "editor",
+                                      "-s", "foo", "bar"])]
+    for name, cmd in commands:
+        def run():
+            subprocess.run(cmd, input=b"foo\n", stdout=subprocess.DEVNULL,
+                           env=env, check=True)
+        total = timeit.timeit(run, number=runs)
+        print("{0:20s} {1:8.1f}ms".format(name, 1000.0 * total / runs))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
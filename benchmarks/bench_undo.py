@@ -0,0 +1,55 @@
+"""
+Compare taking back a sub() that changes a few lines of a large buffer by
+keeping a copy of the buffer from before it, the only way there was, with
+undo(), reporting the time for the sub() and the undo and the memory
+held after the sub(), the new buffer included.
+
+    python benchmarks/bench_undo.py [lines] [changed]
+"""
+import sys
+import time
+import tracemalloc
+
+import editor
+
+
+# -----------------------------------------------------------------------------
+def main(args):
+    """
+    Time a sub() changing *changed* lines of a *lines* line buffer and
+    taking it back each way
+    """
+    nlines = int(args[0]) if len(args) > 0 else 10000000
+    changed = int(args[1]) if len(args) > 1 else 10
+    step = max(1, nlines // changed)
+    lines = ["{0} {1} with some words".format(
+        "hit" if _ % step else "row", _) for _ in range(nlines)]
+
+    def snapshot(q):
+        saved = q.buffer.copy()
+        q.sub("row", "ROW")
+        return lambda: setattr(q, 'buffer', saved)
+
+    def journal(q):
+        q.sub("row", "ROW")
+        return q.undo
+
+    for name, func in [("copy", snapshot), ("undo", journal)]:
+        q = editor.editor(content=lines[:], undo_limit=1)
+        start = time.perf_counter()
+        back = func(q)
+        middle = time.perf_counter()
+        back()
+        end = time.perf_counter()
+        assert q.buffer == lines
+        q = editor.editor(content=lines[:], undo_limit=1)
+        tracemalloc.start()
+        back = func(q)
+        held, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print("{0:6s} sub {1:8.3f}s  undo {2:10.6f}s  held {3:8.3f}MiB".format(
+            name, middle - start, end - middle, held / (1 << 20)))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
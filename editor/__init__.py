@@ -1,21 +1,42 @@
 """
 Manipulate files programmatically
+
+Modules that only some features need (concurrent.futures, subprocess,
+editor.store) are imported where they are used, so that scripts and the
+command line interface start quickly.
 """
+import array
+import collections
+import contextlib
 from datetime import datetime as dt
+import functools
+import importlib
+import io
+import itertools
+import locale
+import operator
 import os
 import re
 import shutil
-import subprocess
 import tempfile
 import types
 
 
 from editor import version
+from editor.lines import ChunkedLines, CompactLines, MappedLines
+from editor.lines import starts_with
 
 
 class editor(object):
+    chunk_bytes = 1 << 24
+    inplace_min = 1 << 16
+    read_size = 1 << 16
+    write_size = 1 << 16
+
     # -------------------------------------------------------------------------
-    def __init__(self, filepath=None, content=[], backup=None, newline='\n'):
+    def __init__(self, filepath=None, content=[], backup=None, newline=None,
+                 stream=False, storage='list', binary=False, encoding=None,
+                 errors=None, atomic=True, undo_limit=0):
         """
         If *filepath* is None, we're creating a new file. The caller will have
         to specify a filepath when calling quit().
@@ -39,13 +60,84 @@ class editor(object):
         just before the new content is written to the file.
 
         File content is held as a list of lines. Line terminators from the file
-        are removed from the content at load time. The default line terminator
-        is '\n', however, this can be overridden using the *newline* argument
-        on the constructor or on quit().
+        are removed from the content at load time. The file is read in
+        blocks of *read_size* characters, which are split into lines
+        natively, and the terminators found are recorded in self.newlines
+        the way io records them: None, one of '\n', '\r\n', and '\r', or a
+        tuple of those seen when the file mixes them. If the file uses one
+        terminator, that is the default line terminator, so it is kept when
+        the file is saved. Otherwise it is '\n'. Either way, this can be
+        overridden using the *newline* argument on the constructor or on
+        quit(). With storage='mmap' and in stream mode, only the first line
+        is looked at, and only '\n' and '\r\n' are recognized.
+
+        If *stream* is True, the file is not loaded. Calls to sub(), delete(),
+        append() and insert() are recorded as pipeline stages and quit() runs
+        the file through them a line at a time, so memory use does not grow
+        with the size of the file. In this mode, self.buffer is None.
+
+        *storage* chooses the container that holds the lines:
+
+            'list'      a plain list (the default)
+            'chunked'   editor.lines.ChunkedLines, which makes insert() and
+                        deleting single lines in the middle of a large
+                        buffer O(log n) rather than O(n)
+            'compact'   editor.lines.CompactLines, which packs the lines
+                        into large strings with an array of line offsets,
+                        for files with so many short lines that the
+                        per-line object overhead dominates
+            'mmap'      editor.lines.MappedLines, which maps the file and
+                        decodes lines only when they are read, so opening
+                        a huge file to look at or change a few lines is
+                        nearly free
+
+        If *binary* is True, the file is read and written as bytes: the
+        buffer holds bytes lines, *newline* and the lines passed to
+        append() and insert() are bytes, and sub(), sub_many(), and delete()
+        take bytes patterns. Nothing is decoded, so any content survives a
+        round trip and lines are split on b'\\n' only. Otherwise, *encoding*
+        and *errors* are used as open() uses them wherever the file is read
+        or written. *encoding* defaults to what open() would use.
+
+        If *atomic* is True, quit() writes the whole file to a temporary
+        file in the same directory, syncs it to disk, and renames it over
+        the original, so a crash part way through a save leaves either the
+        old content or the new, never a truncated file. The new file gets
+        the original's permissions and, where allowed, its owner. Pass
+        False to write into the original file instead, which keeps its
+        inode and hard links and allows rewriting just the changed end of
+        it in place. Either way, when the only change is lines added at the
+        end, quit() appends them to the original as described there, so a
+        crash during that append can leave part of the new lines behind,
+        though never lose the old content.
+
+        *undo_limit* is how many changes undo() can take back. The journal
+        is off by default, since a change that rewrites most of a large
+        buffer is journaled as a whole copy of it. Set self.undo_limit to
+        change it later.
         """
+        if storage not in _storage:
+            raise Error("Unknown storage '{0}'".format(storage))
         self.filepath = filepath
+        self.binary = binary
+        self._autonl = newline is None
+        if newline is None:
+            newline = '\n'
+        if binary:
+            self.encoding = self.errors = None
+            if isinstance(newline, str):
+                newline = newline.encode('ascii')
+        else:
+            self.encoding = encoding or locale.getpreferredencoding(False)
+            self.errors = errors or 'strict'
         self.newline = newline
-        if isinstance(content, str):
+        self.newlines = None
+        self.stream = stream
+        self.atomic = atomic
+        self.undo_limit = undo_limit
+        self._storage = _storage[storage]
+        self._stages = [] if stream else None
+        if isinstance(content, (str, bytes)):
             self.buffer = content.rstrip(self.newline).split(self.newline)
         else:
             self.buffer = content
@@ -53,9 +145,16 @@ class editor(object):
         self.backup = {}
         self.backup_setup(backup)
 
-        if self.filepath is None:
-            return
-        if not os.path.exists(self.filepath):
+        self._source = self.buffer
+        self._loaded = None
+        self._pending = None
+        self._target = None
+        self._workers = None
+        self._undo = []
+        self._redo = []
+
+        if self.filepath is None or not os.path.exists(self.filepath):
+            self.buffer = None if self.stream else self._store(self.buffer)
             return
         if self.buffer:
             raise Error("""{0} exists. To overwrite it,
@@ -64,16 +163,39 @@ class editor(object):
                 f.update(...)
                 f.quit(save=True)
             """.format(self.filepath))
+        elif self.stream:
+            self.buffer = None
+            self._source = self.filepath
+            self._found(_sniff(self.filepath, self.binary))
+            if self.backup['when'] == 'load':
+                self._backup_load()
         else:
-            self.buffer = self.contents(self.filepath)
+            self._loadstat = os.stat(self.filepath)
+            if hasattr(self._storage, 'load'):
+                self.buffer = self._storage.load(self.filepath, self.encoding,
+                                                 self.errors, self.binary)
+                self._found(_sniff(self.filepath, self.binary))
+            else:
+                seen = set()
+                lines = itertools.chain.from_iterable(_read_blocks(
+                    self._open(self.filepath, newline=''), seen,
+                    self.read_size))
+                self.buffer = self._store(list(lines) if self._storage is list
+                                          else lines)
+                self._found(seen)
+            if isinstance(self.buffer, MappedLines):
+                self._loaded = self.buffer.copy()
+            else:
+                self._loaded = array.array('q', map(hash, self.buffer))
             if self.backup['when'] == 'load':
-                self.backup['func'](self.backup['ext'])
+                self._backup_load()
 
     # -------------------------------------------------------------------------
     def __len__(self):
         """
         Return the length of the buffer
         """
+        self._require_buffer("len()")
         return len(self.buffer)
 
     # -------------------------------------------------------------------------
@@ -81,7 +203,11 @@ class editor(object):
         """
         Add *line* to the end of the file
         """
-        self.buffer.append(line)
+        if self._stages is not None:
+            self._stages.append(('append', line))
+        else:
+            self.buffer.append(line)
+            self._journal(('append', line))
 
     # -------------------------------------------------------------------------
     def backup_filename(self):
@@ -99,18 +225,85 @@ class editor(object):
         *backup* may be 'load', 'save', extension string, a function pointer,
         or a tuple containing a combination of these (except that 'load' and
         'save' are mutually exclusive).
+
+        'noappend' skips the save time backup when quit() finds that the
+        only change was lines added at the end of the file, since those are
+        simply appended and the original content is left in place.
+
+        The default backup routine copies the file with shutil.copy2(). One
+        of these keywords makes it use another method:
+
+            'rename'    move the original to the backup name and save to a
+                        new file, so nothing is copied. At load time, or
+                        when quit() saves to another file, the original
+                        has to stay in place, so this links it like
+                        'hardlink' does.
+            'hardlink'  make the backup a hard link to the original, and
+                        save to a new file that replaces it
+            'reflink'   clone the file (ioctl FICLONE), which shares the
+                        data blocks on filesystems that support it, such
+                        as btrfs and XFS
+            'copyrange' copy the file in the kernel with
+                        os.copy_file_range()
+
+        Where a method is not available, the backup falls back to the next
+        one down this list and in the end to shutil.copy2().
+
+        'background' runs a load time backup in a worker thread so the
+        constructor returns without waiting for it. quit() waits for it to
+        finish before writing anything, and raises any exception it raised.
+
+        A dict sets options for the default backup routine:
+
+            'compress'  'gzip', 'bz2', or 'lzma': write the backup through
+                        that compressor, adding '.gz', '.bz2', or '.xz' to
+                        its name. This overrides the methods above.
+            'keep'      after each backup, keep only this many of the
+                        newest backups of the file, including the new one
+            'maxage'    after each backup, remove backups older than this
+                        many seconds (or this datetime.timedelta), other
+                        than the new one
+            'store'     keep the backup in the editor.store.BackupStore in
+                        this directory, which stores content shared with
+                        earlier backups only once. This overrides
+                        'compress' and the methods above.
+
+        Old backups are found by matching the names in the file's directory
+        against the extension format, so 'keep' and 'maxage' only see
+        backups made with the same extension.
         """
         def bs_resolve(val):
             if val == 'load':
                 self.backup['when'] = val
             elif val == 'save':
                 pass
+            elif val == 'noappend':
+                self.backup['append'] = False
+            elif val == 'background':
+                self.backup['background'] = True
+            elif isinstance(val, dict):
+                for key in val:
+                    if key not in ('compress', 'keep', 'maxage', 'store'):
+                        raise Error("Unknown backup option '{0}'".format(key))
+                compress = val.get('compress')
+                if compress is not None and compress not in _compress_ext:
+                    raise Error("Unknown compression '{0}'".format(compress))
+                self.backup.update(val)
+            elif val in _backup_method:
+                self.backup['method'] = val
             elif isinstance(val, types.FunctionType):
                 self.backup['func'] = val
             elif isinstance(val, str):
                 self.backup['ext'] = val
 
         self.backup['when'] = 'save'
+        self.backup['append'] = True
+        self.backup['background'] = False
+        self.backup['compress'] = None
+        self.backup['keep'] = None
+        self.backup['maxage'] = None
+        self.backup['store'] = None
+        self.backup['method'] = 'copy'
         self.backup['func'] = self.default_backup
         self.backup['ext'] = ".%Y.%m%d.%H%M%S"
         self.backup['filepath'] = self.filepath
@@ -121,36 +314,171 @@ class editor(object):
         else:
             bs_resolve(backup)
 
+    # -------------------------------------------------------------------------
+    @contextlib.contextmanager
+    def batch(self):
+        """
+        Queue the sub(), delete(), append(), and insert() calls made inside a
+        with block and apply them all in a single pass over the buffer when
+        the block exits. The result is the same as making the calls one
+        after another. Lists returned by delete() inside the block are
+        filled in when it exits.
+
+        If the block raises an exception, the queued calls are discarded and
+        the buffer is left as it was.
+
+            with q.batch():
+                q.sub('foo', 'bar')
+                gone = q.delete('^#')
+        """
+        if self._stages is not None:
+            yield self
+            return
+        self._stages = []
+        try:
+            yield self
+            stages = self._stages
+        finally:
+            self._stages = None
+        if stages:
+            self._update(self.buffer, pipeline(self.buffer, stages))
+
+    # -------------------------------------------------------------------------
+    def changed(self):
+        """
+        Return True if the buffer no longer holds the lines loaded from the
+        file. Content that was not loaded from a file counts as changed. In
+        stream mode, the answer is whether any edits have been recorded.
+        """
+        if self.stream:
+            return bool(self._stages)
+        if self._loaded is None:
+            return True
+        return (len(self.buffer) != len(self._loaded) or
+                self._kept() < len(self._loaded))
+
     # -------------------------------------------------------------------------
     @staticmethod
-    def contents(filepath):
+    def contents(filepath, encoding=None, errors=None, binary=False):
         """
         Read a file and return its contents as a list. \n and \r are removed
-        from the end of each line.
+        from the end of each line. *encoding* and *errors* are passed to
+        open(). If *binary* is True, the lines are bytes.
         """
-        f = open(filepath, 'r')
-        rval = [x.rstrip("\r\n") for x in f.readlines()]
-        f.close()
-        return rval
+        if binary:
+            f = open(filepath, 'rb')
+        else:
+            f = open(filepath, 'r', encoding=encoding, errors=errors,
+                     newline='')
+        return list(itertools.chain.from_iterable(
+            _read_blocks(f, set(), editor.read_size)))
 
     # -------------------------------------------------------------------------
     def default_backup(self, ext):
         """
         This default backup routine will copy *filepath* to, for example,
-        *filepath*~2015.0112.093715
+        *filepath*~2015.0112.093715, using the method chosen in
+        backup_setup()
         """
         ts = dt.now().strftime(ext)
         self._backup_filename = self.backup['filepath'] + ts
-        shutil.copy2(self.backup['filepath'], self._backup_filename)
+        compress = self.backup['compress']
+        named = self.backup['filepath']
+        if self.backup['store']:
+            from editor.store import BackupStore
+            store = BackupStore(self.backup['store'])
+            named = os.path.join(store.manifest_dir(named),
+                                 os.path.basename(named))
+            self._backup_filename = store.save(self.backup['filepath'],
+                                               os.path.basename(named) + ts)
+        elif compress:
+            self._backup_filename += _compress_ext[compress]
+            _backup_compressed(self.backup['filepath'],
+                               self._backup_filename, compress)
+        else:
+            method = self.backup['method']
+            # the original may only be moved away when quit() is about to
+            # put the new content in its place
+            if method == 'rename' and self._target != self.filepath:
+                method = 'hardlink'
+            _backup_method[method](self.backup['filepath'],
+                                   self._backup_filename)
+        if (self.backup['keep'] is not None or
+                self.backup['maxage'] is not None):
+            _prune(named, ext, self._backup_filename, self.backup['keep'],
+                   self.backup['maxage'])
 
     # -------------------------------------------------------------------------
-    def delete(self, rgx):
+    def delete(self, rgx, literal=None, workers=None):
         """
         Delete lines that match the regex *rgx*. Return the lines removed.
+        *rgx* may be a string or a compiled pattern. *literal* and *workers*
+        work as they do for sub().
+
+        In stream mode, the deletion happens at quit() time and the removed
+        lines are not kept, so None is returned. Inside a batch() block, the
+        list returned is filled in when the block exits.
+        """
+        if self.stream:
+            self._stages.append(('delete', rgx, None, literal))
+            self._workers = max(self._workers or 0, workers or 0) or None
+            return None
+        elif self._stages is not None:
+            rval = []
+            self._stages.append(('delete', rgx, rval, literal))
+            return rval
+        if workers and workers > 1:
+            results = self._parallel(_chunk_delete, workers, rgx, literal)
+            kept = itertools.chain.from_iterable(x[0] for x in results)
+            rval = list(itertools.chain.from_iterable(x[1] for x in results))
+            idx = array.array('q')
+            base = 0
+            for left, removed, where in results:
+                idx.extend(base + _ for _ in where)
+                base += len(left) + len(removed)
+        else:
+            hits = list(_search(self.buffer, rgx, literal))
+            kept = itertools.compress(self.buffer, map(operator.not_, hits))
+            rval = list(itertools.compress(self.buffer, hits))
+            idx = array.array('q', itertools.compress(itertools.count(), hits))
+        if not rval:
+            return rval
+        # deleting from a ChunkedLines in place keeps the chunks it shares
+        # with a snapshot() shared, and from a MappedLines keeps its map
+        sparse = 3 * len(idx) <= len(self.buffer)
+        if sparse and isinstance(self.buffer, MappedLines):
+            self.buffer.splice(idx)
+        elif sparse and isinstance(self.buffer, ChunkedLines):
+            for where in reversed(idx):
+                del self.buffer[where]
+        else:
+            self.buffer = self._store(kept)
+        self._journal(('delete', idx, tuple(rval)))
+        return rval
+
+    # -------------------------------------------------------------------------
+    def diff(self, snapshot):
         """
-        newbuf = [l for l in self.buffer if not re.search(rgx, l)]
-        rval = [l for l in self.buffer if re.search(rgx, l)]
-        self.buffer = newbuf
+        Return the line ranges where the buffer differs from *snapshot*, a
+        copy taken by snapshot(), as a list of (i1, i2, j1, j2) tuples
+        saying that snapshot[i1:i2] became self.buffer[j1:j2].
+
+        With storage='chunked' or 'compact', the chunks the two still share
+        are known to match and are skipped without comparing their lines.
+        Between them, or throughout for other storages, each run of
+        changed lines is reported if the number of lines is the same, and
+        a single range from the first difference to the last otherwise.
+        """
+        self._require_buffer("diff()")
+        old, new = snapshot, self.buffer
+        blocks = []
+        if type(old) is type(new) and hasattr(old, 'matching_blocks'):
+            blocks = old.matching_blocks(new)
+        rval = []
+        i = j = 0
+        for a, b, size in blocks + [(len(old), len(new), 0)]:
+            rval.extend(_changed_ranges(old[i:a], new[j:b], i, j))
+            i, j = a + size, b + size
         return rval
 
     # -------------------------------------------------------------------------
@@ -158,24 +486,33 @@ class editor(object):
         """
         Edit the file in the user's default command line editor
         """
+        self._require_buffer("edit()")
         _, tmp = tempfile.mkstemp()
-        with open(tmp, 'w') as f:
-            f.write("".join([x + self.newline for x in self.buffer]))
+        with self._open(tmp, 'w') as f:
+            _write_lines(f, self.buffer, self.newline, self.write_size)
         cledit = os.getenv('EDITOR') or 'vi'
+        import subprocess
         p = subprocess.Popen([cledit, tmp])
         p.wait()
-        buffer = editor.contents(tmp)
+        buffer = editor.contents(tmp, self.encoding, self.errors, self.binary)
         if not buffer:
             return
         else:
-            self.buffer = buffer
+            self._update(self.buffer, buffer)
 
     # -------------------------------------------------------------------------
     def insert(self, line, where=0):
         """
         Insert *line* after line *where*
         """
-        self.buffer.insert(where, line)
+        if self._stages is not None:
+            self._stages.append(('insert', line, where))
+        else:
+            size = len(self.buffer)
+            self.buffer.insert(where, line)
+            if where < 0:
+                where += size
+            self._journal(('insert', min(max(where, 0), size), line))
 
     # -------------------------------------------------------------------------
     def quit(self, save=True, filepath=None, backup=None, newline=None):
@@ -191,14 +528,52 @@ class editor(object):
         used.
 
         If *newline* is specified, its value will be used as the line
-        terminator.
+        terminator. If neither it nor the constructor's *newline* is, and
+        the buffer is as it was loaded from a file that mixes terminators,
+        the file is left as it is.
+
+        In stream mode, the source is read a line at a time, passed through
+        the recorded stages, and written to a temporary file in the target's
+        directory which then replaces the target. With storage='mmap', the
+        buffer is saved the same way, since the original is still mapped.
+
+        If the only change since the file was loaded is lines added at the
+        end, and the file is still as it was loaded and ends with the line
+        terminator, just the new lines are appended to it. Lines already in
+        the file keep their terminators in that case.
+
+        Otherwise, the file is written through a temporary file as described
+        for *atomic* in the constructor. If *atomic* is False, the file is
+        still as it was loaded, and at least *inplace_min* bytes at the
+        start of it would be written back unchanged, the file is rewritten
+        in place from the first changed line on and truncated after the
+        last, rather than written in full.
+
+        Either way, the lines of the buffer are joined and written about
+        *write_size* characters at a time, so saving takes little memory
+        beyond the buffer itself.
+
+        With the 'rename' and 'hardlink' backup methods, the original file
+        becomes the backup, so the content is always written to a new file
+        that takes its place.
+
+        A load time backup running in the background is waited for first,
+        even if *save* is False, and if it failed, its exception is raised
+        here.
+
+        If saving would write back exactly what the file already holds, no
+        backup is made and the file is not touched. Return True if the file
+        was written and False otherwise.
         """
         if self.closed:
             raise Error("This file is already closed")
 
         self.closed = True
+        if self._pending is not None:
+            pending, self._pending = self._pending, None
+            pending.result()
         if not save:
-            return
+            return False
 
         if backup:
             self.backup_setup(backup)
@@ -208,28 +583,1223 @@ class editor(object):
         if wtarget is None:
             raise Error("No filepath specified, content will be lost")
             self.closed = False
-        elif os.path.exists(wtarget) and self.backup['when'] == 'save':
-            self.backup['func'](self.backup['ext'])
+
+        # open the stream source before the backup runs so that a backup
+        # routine that moves the original out of the way can't pull it out
+        # from under us
+        if self.stream:
+            source = self._open_source()
+            if self._workers and isinstance(self._source, str):
+                srcstat = os.stat(self._source)
 
         nl = newline or self.newline
-        out = open(wtarget, 'w')
-        out.writelines([l + nl for l in self.buffer])
+        if self.binary and isinstance(nl, str):
+            nl = nl.encode('ascii')
+        if not self.stream and self._unchanged(wtarget, nl, newline is None):
+            return False
+        fresh = (wtarget == self.filepath and
+                 self.backup['func'] == self.default_backup and
+                 self.backup['method'] in ('hardlink', 'rename') and
+                 not self.backup['compress'] and not self.backup['store'])
+        added = None
+        if not self.stream and not fresh:
+            added = self._appended(wtarget, nl)
+
+        if os.path.exists(wtarget) and self.backup['when'] == 'save':
+            if added is None or self.backup['append']:
+                self._target = wtarget
+                self.backup['func'](self.backup['ext'])
+                # the backup routine may have moved or changed the file
+                if added is not None and not self._untouched(wtarget):
+                    added = None
+
+        if added is not None:
+            with self._open(wtarget, 'a') as out:
+                _write_lines(out, added, nl, self.write_size)
+            return True
+        like = None
+        if fresh and self.backup['method'] == 'rename':
+            like = self.backup_filename()
+        if self.stream:
+            if self._workers and isinstance(self._source, str):
+                split = _split_stages(self._stages)
+                try:
+                    moved = not os.path.samestat(srcstat,
+                                                 os.stat(self._source))
+                except OSError:
+                    moved = True
+                if split and not moved:
+                    self._replace(wtarget, lambda out: _parallel_stream(
+                        out, self._source, split, nl, self._workers,
+                        self.chunk_bytes, self.encoding, self.errors), like)
+                    return True
+            lines = (x + nl for x in pipeline(source, self._stages))
+            self._replace(wtarget, lambda out: out.writelines(lines), like)
+            return True
+        elif fresh or self.atomic or isinstance(self.buffer, MappedLines):
+            self._replace(wtarget, lambda out: self._write(out, nl), like)
+            return True
+
+        region = self._inplace(wtarget, nl)
+        if region is not None:
+            offset, first = region
+            out = open(wtarget, 'r+b')
+            out.seek(offset)
+            if not self.binary:
+                out = io.TextIOWrapper(out, self.encoding, self.errors,
+                                       newline='')
+            with out:
+                _write_lines(out, itertools.islice(self.buffer, first, None),
+                             nl, self.write_size)
+                out.truncate()
+            return True
+
+        out = self._open(wtarget, 'w')
+        self._write(out, nl)
         out.close()
+        return True
+
+    # -------------------------------------------------------------------------
+    def redo(self):
+        """
+        Make the last change undone by undo() again. Return False if there
+        is nothing to redo. Any other change to the buffer clears the
+        changes waiting to be redone.
+        """
+        self._require_buffer("redo()")
+        return self._replay(self._redo, self._undo, True)
 
     # -------------------------------------------------------------------------
-    def sub(self, rgx, repl, count=0):
+    def restore(self, snapshot):
+        """
+        Put the buffer back the way it was when *snapshot* was taken by
+        snapshot(). The snapshot is copied, not used, so it can be restored
+        again later, and the restore can be taken back with undo(). Not
+        available inside a batch() block.
         """
-        Replace matches of *rgx* with *repl* on each line in the file
+        self._require_buffer("restore()")
+        if self._stages is not None:
+            raise Error("restore() is not available in batch()")
+        old = self.buffer
+        self.buffer = self._store(snapshot.copy())
+        self._journal(('replace', old, self.buffer))
+
+    # -------------------------------------------------------------------------
+    def snapshot(self):
+        """
+        Return a copy of the buffer to hand to restore() or diff() later.
+
+        With storage='chunked', the copy shares its chunks with the buffer
+        and each side duplicates a chunk only when it first changes it, so
+        a snapshot costs a list of chunks, about n / 512 slots, and editing
+        afterwards duplicates just the chunks touched. storage='compact'
+        shares its packed blocks the same way. With other storages, the
+        snapshot is a shallow copy, which shares the lines themselves.
+        """
+        self._require_buffer("snapshot()")
+        return self.buffer.copy()
+
+    # -------------------------------------------------------------------------
+    def sub(self, rgx, repl, count=0, literal=None, joined=False,
+            workers=None):
+        """
+        Replace matches of *rgx* with *repl* on each line in the file. *rgx*
+        may be a string or a compiled pattern. Return the number of lines
+        changed (None in stream mode or inside a batch() block).
+
+        If *literal* is True, *rgx* and *repl* are plain text and the
+        replacement is done with str.replace(). If *literal* is None, that
+        happens whenever *rgx* is a string with no regex metacharacters and
+        *repl* has no backslashes. Lines that don't contain *rgx* are kept
+        as they are.
+
+        If *joined* is True, the buffer is joined into one string, *rgx* is
+        applied to it once with re.MULTILINE, and the result is split back
+        into lines. This is faster when most lines match, but *rgx* must
+        not match across line boundaries or depend on \\A or \\Z. If the
+        number of lines would change, Error is raised and the buffer is left
+        alone. *count* and lines that contain '\\n' are not supported in
+        this mode, so they fall back to the line by line substitution.
+
+        If *workers* is more than 1, the buffer is split into pieces that
+        are substituted in a pool of that many processes and put back
+        together in order, which pays off for large buffers and costly
+        patterns. *joined* is ignored then. In stream mode, quit() instead
+        splits the file into ranges of about *chunk_bytes* bytes, cut at
+        line ends, and runs them through the recorded stages in the pool,
+        as long as every stage but trailing append()s works line by line.
+        *workers* has no effect inside a batch() block.
         """
         count = max(count, 0)
-        newbuf = [re.sub(rgx, repl, line, count) for line in self.buffer]
-        self.buffer = newbuf
+        if self._stages is not None:
+            self._stages.append(('sub', rgx, repl, count, literal))
+            if self.stream:
+                self._workers = max(self._workers or 0, workers or 0) or None
+            return None
+        old = self.buffer
+        if workers and workers > 1:
+            results = self._parallel(_chunk_sub, workers, rgx, repl, count,
+                                     literal)
+            return self._update(old, itertools.chain.from_iterable(
+                x[0] for x in results))
+        if joined and count == 0 and old:
+            sep = b"\n" if self.binary else "\n"
+            text = sep.join(old)
+            if text.count(sep) == len(old) - 1:
+                if literal is None:
+                    literal = _is_literal(rgx, repl)
+                if literal:
+                    text = text.replace(getattr(rgx, 'pattern', rgx), repl)
+                else:
+                    text = _regex(rgx, re.MULTILINE).sub(repl, text)
+                new = text.split(sep)
+                if len(new) != len(old):
+                    raise Error("Substitution changed the number of lines")
+                return self._update(old, new)
+        return self._update(old, _stage_sub(old, rgx, repl, count, literal))
+
+    # -------------------------------------------------------------------------
+    def sub_many(self, mapping, literal=None):
+        """
+        Apply several substitutions in one scan of each line. *mapping* is a
+        dict or a sequence of (rgx, repl) pairs. Return the number of lines
+        changed (None in stream mode or inside a batch() block).
+
+        The patterns are combined into a single alternation. Scanning each
+        line from left to right, the first pattern in *mapping* order that
+        matches at a position wins, so when one literal is a prefix of
+        another, list the longer one first. Replacements are inserted as
+        given, without backslash or group reference processing. Patterns
+        must not use numbered backreferences or share group names.
+
+        If *literal* is True, every pattern is plain text. If it is None,
+        patterns with no regex metacharacters are plain text anyway.
+        """
+        pairs = list(mapping.items() if hasattr(mapping, 'items') else
+                     mapping)
+        if self._stages is not None:
+            self._stages.append(('sub_many', pairs, literal))
+            return None
+        old = self.buffer
+        return self._update(old, _stage_sub_many(old, pairs, literal))
+
+    # -------------------------------------------------------------------------
+    def undo(self):
+        """
+        Take back the last change made to the buffer by sub(), sub_many(),
+        delete(), append(), insert(), a batch() block, or edit(). Return
+        False if there is nothing to undo, which is always the case unless
+        the constructor was given *undo_limit*; only that many of the latest
+        changes are kept. Calls that changed nothing are not recorded, and
+        neither are changes made to self.buffer directly, so don't mix the
+        two.
+
+        Each change is recorded as the indices of the lines it touched with
+        their old and new values, so undoing a sub() that changed ten lines
+        of a large file takes time and memory for ten lines. A change that
+        touches most lines, or that changes the number of lines in a batch()
+        block or edit(), keeps the whole buffer as it was instead.
+
+        Not available in stream mode or inside a batch() block.
+        """
+        self._require_buffer("undo()")
+        return self._replay(self._undo, self._redo, False)
 
     # -------------------------------------------------------------------------
     @classmethod
     def version(cls):
         return version.__version__
 
+    # -------------------------------------------------------------------------
+    def _appended(self, wtarget, nl):
+        """
+        If saving to *wtarget* only needs the lines added at the end of the
+        buffer since load, return them. That is the case when *wtarget* is
+        the file we loaded, it has not changed on disk since, it ends with
+        *nl*, and the buffer still starts with the lines loaded from it.
+        Otherwise, return None.
+        """
+        if (not self._untouched(wtarget) or
+                len(self.buffer) <= len(self._loaded) or
+                not self._ends_with(wtarget, nl)):
+            return None
+        if self._kept() < len(self._loaded):
+            return None
+        return self.buffer[len(self._loaded):]
+
+    # -------------------------------------------------------------------------
+    def _backup_load(self):
+        """
+        Run the load time backup, or start it in a worker thread if the
+        'background' keyword was given
+        """
+        if self.backup['background']:
+            self._pending = _background(self.backup['func'],
+                                        self.backup['ext'])
+        else:
+            self.backup['func'](self.backup['ext'])
+
+    # -------------------------------------------------------------------------
+    def _ends_with(self, wtarget, nl):
+        """
+        Return True if the file *wtarget*, as loaded, is empty or its last
+        line ended with *nl* (and not with a longer terminator that ends the
+        same way, like '\\r\\n' for '\\n')
+        """
+        size = self._loadstat.st_size
+        if not size:
+            return True
+        term = nl if self.binary else nl.encode(self.encoding)
+        with open(wtarget, 'rb') as f:
+            f.seek(max(0, size - len(term) - 1))
+            last = f.read()
+        return last.endswith(term) and not last.endswith(b'\r' + term)
+
+    # -------------------------------------------------------------------------
+    def _found(self, seen):
+        """
+        Record the set of line terminators *seen* in the file in
+        self.newlines and, unless the constructor was given a newline, make
+        the file's terminator the default if it used just one
+        """
+        self.newlines = _newlines(seen)
+        if self._autonl and isinstance(self.newlines, (str, bytes)):
+            self.newline = self.newlines
+
+    # -------------------------------------------------------------------------
+    def _inplace(self, wtarget, nl):
+        """
+        If *wtarget* is the file we loaded, it has not changed on disk since,
+        each of its lines ended with *nl*, and the lines the buffer shares
+        with it at the start take up at least *inplace_min* bytes and, as
+        written, end where the file has the last of them, return (byte
+        offset, line number) of the first line that differs. Otherwise,
+        return None.
+        """
+        if (isinstance(self.buffer, MappedLines) or
+                self.errors not in _lossless or
+                self.newlines != nl or
+                not self._untouched(wtarget) or
+                not self._ends_with(wtarget, nl)):
+            return None
+        first = self._kept()
+        offset = _encoded_size(itertools.islice(self.buffer, first), nl,
+                               self.encoding, self.errors)
+        if not first or offset < self.inplace_min:
+            return None
+        last = self.buffer[first - 1] + nl
+        if not self.binary:
+            last = last.encode(self.encoding, self.errors)
+        with open(wtarget, 'rb') as f:
+            f.seek(offset - len(last))
+            if f.read(len(last)) != last:
+                return None
+        return offset, first
+
+    # -------------------------------------------------------------------------
+    def _journal(self, entry):
+        """
+        Record *entry* for undo(), keeping no more than *undo_limit*
+        entries, and forget anything waiting to be redone
+        """
+        del self._redo[:]
+        if self.undo_limit > 0:
+            self._undo.append(entry)
+        del self._undo[:max(0, len(self._undo) - self.undo_limit)]
+
+    # -------------------------------------------------------------------------
+    def _kept(self):
+        """
+        Return how many lines at the start of the buffer are still the ones
+        loaded from the file. Apart from a MappedLines buffer, which keeps a
+        copy sharing its map, only the hash of each loaded line is kept.
+        """
+        loaded = self._loaded
+        if isinstance(loaded, MappedLines):
+            if starts_with(self.buffer, loaded):
+                return len(loaded)
+            lines = self.buffer
+        else:
+            lines = map(hash, self.buffer)
+        return next(itertools.compress(itertools.count(),
+                                       map(operator.ne, lines, loaded)),
+                    min(len(self.buffer), len(loaded)))
+
+    # -------------------------------------------------------------------------
+    def _open(self, path, mode='r', newline=None):
+        """
+        Open *path* (a file name or descriptor) with *mode*, as bytes in
+        binary mode or with the encoding and error handler chosen at
+        construction and *newline* otherwise
+        """
+        if self.binary:
+            return open(path, mode + 'b')
+        return open(path, mode, encoding=self.encoding, errors=self.errors,
+                    newline=newline)
+
+    # -------------------------------------------------------------------------
+    def _open_source(self):
+        """
+        Return an iterator over the lines of the stream source with line
+        terminators removed
+        """
+        if isinstance(self._source, str):
+            return self._read(self._source)
+        return iter(self._source or [])
+
+    # -------------------------------------------------------------------------
+    def _parallel(self, func, workers, *args):
+        """
+        Split the buffer into pieces, call func(piece, *args) on each in a
+        pool of *workers* processes, and return the results in order
+        """
+        step = max(1, -(-len(self.buffer) // (workers * 4)))
+        lines = iter(self.buffer)
+        pieces = iter(lambda: list(itertools.islice(lines, step)), [])
+        args = [itertools.repeat(_) for _ in args]
+        import concurrent.futures
+        with concurrent.futures.ProcessPoolExecutor(workers) as pool:
+            return list(pool.map(func, pieces, *args))
+
+    # -------------------------------------------------------------------------
+    def _read(self, path):
+        """
+        Return an iterator over the lines of the file at *path* with line
+        terminators removed
+        """
+        return _read_lines(self._open(path), b"\r\n" if self.binary else
+                           "\r\n")
+
+    # -------------------------------------------------------------------------
+    def _replace(self, wtarget, write, like=None):
+        """
+        Call write(out) on a temporary file next to *wtarget*, sync it to
+        disk, then move it into place, keeping the permissions and, where
+        allowed, the owner of the file it replaces (or of *like*, if that is
+        given). A new file gets the mode open() would give it. If *wtarget*
+        is a symbolic link, the file it points to is replaced, not the link.
+        """
+        wtarget = os.path.realpath(wtarget)
+        tdir = os.path.dirname(wtarget)
+        fd, tmp = tempfile.mkstemp(dir=tdir,
+                                   prefix="." + os.path.basename(wtarget))
+        like = like or wtarget
+        try:
+            with self._open(fd, 'w') as out:
+                write(out)
+                out.flush()
+                os.fsync(out.fileno())
+            if os.path.exists(like):
+                shutil.copymode(like, tmp)
+                stat = os.stat(like)
+                try:
+                    os.chown(tmp, stat.st_uid, stat.st_gid)
+                except (AttributeError, OSError):
+                    pass
+            else:
+                umask = os.umask(0)
+                os.umask(umask)
+                os.chmod(tmp, 0o666 & ~umask)
+            os.replace(tmp, wtarget)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+
+    # -------------------------------------------------------------------------
+    def _replay(self, source, dest, forward):
+        """
+        Pop the last entry from journal *source*, apply it to the buffer
+        (backward unless *forward* is True), and push it onto *dest*. Return
+        False if *source* is empty.
+        """
+        if self._stages is not None:
+            raise Error("undo() and redo() are not available in batch()")
+        if not source:
+            return False
+        entry = source.pop()
+        kind, lines = entry[0], self.buffer
+        if kind == 'set':
+            for where, line in zip(entry[1], entry[3 if forward else 2]):
+                lines[where] = line
+        elif kind == 'replace':
+            # later changes may have swapped the buffer for an equal one, so
+            # the way back goes to the buffer we are leaving
+            if forward:
+                entry = (kind, lines, entry[2])
+            else:
+                entry = (kind, entry[1], lines)
+            self.buffer = entry[2 if forward else 1]
+        elif kind == 'append':
+            if forward:
+                lines.append(entry[1])
+            else:
+                del lines[len(lines) - 1]
+        elif kind == 'insert':
+            if forward:
+                lines.insert(entry[1], entry[2])
+            else:
+                del lines[entry[1]]
+        elif len(entry[1]) <= 32:
+            if forward:
+                for where in reversed(entry[1]):
+                    del lines[where]
+            else:
+                for where, line in zip(entry[1], entry[2]):
+                    lines.insert(where, line)
+        elif forward:
+            keep = bytearray(b"\x01") * len(lines)
+            for where in entry[1]:
+                keep[where] = 0
+            self.buffer = self._store(itertools.compress(lines, keep))
+        else:
+            self.buffer = self._store(_undelete(lines, entry[1], entry[2]))
+        dest.append(entry)
+        return True
+
+    # -------------------------------------------------------------------------
+    def _require_buffer(self, what):
+        """
+        Stream mode has no buffer. Complain if *what* needs one.
+        """
+        if self.buffer is None:
+            raise Error("{0} is not available in stream mode".format(what))
+
+    # -------------------------------------------------------------------------
+    def _store(self, lines):
+        """
+        Return *lines* in the container chosen by the *storage* argument to
+        the constructor
+        """
+        if isinstance(lines, self._storage):
+            return lines
+        return self._storage(lines)
+
+    # -------------------------------------------------------------------------
+    def _unchanged(self, wtarget, nl, keep):
+        """
+        Return True if saving to *wtarget* with line terminator *nl* would
+        write back exactly the bytes already there: *wtarget* is the file we
+        loaded, it has not changed on disk since, the buffer holds the lines
+        loaded from it, and each of them, the last one included, ended with
+        *nl*. If *keep* is True
+        and no newline was given to the constructor, the file's own mix of
+        terminators counts as well.
+        """
+        if self.changed() or not self._untouched(wtarget):
+            return False
+        if keep and self._autonl and isinstance(self.newlines, tuple):
+            return True
+        if self._loadstat.st_size and (self.newlines != nl or
+                                       not self._ends_with(wtarget, nl)):
+            return False
+        if isinstance(self.buffer, MappedLines):
+            rval = self.buffer.reproduces(nl)
+            if rval is not None:
+                return rval
+        return (_encoded_size(self.buffer, nl, self.encoding, self.errors) ==
+                self._loadstat.st_size)
+
+    # -------------------------------------------------------------------------
+    def _untouched(self, wtarget):
+        """
+        Return True if *wtarget* is the file we loaded and its inode, size,
+        and modification time are still what they were at load time
+        """
+        if self._loaded is None or wtarget != self.filepath:
+            return False
+        try:
+            stat = os.stat(wtarget)
+        except OSError:
+            return False
+        was = self._loadstat
+        return ((stat.st_ino, stat.st_size, stat.st_mtime_ns) ==
+                (was.st_ino, was.st_size, was.st_mtime_ns))
+
+    # -------------------------------------------------------------------------
+    def _update(self, old, lines):
+        """
+        Replace the buffer *old* with the lines of the iterable *lines*,
+        record the change for undo(), and return the number of lines that
+        differ. If the line count is the same and at most a third of the
+        lines changed, just those are recorded, and a ChunkedLines buffer
+        is changed in place, so chunks shared with a snapshot() stay shared,
+        as is a MappedLines buffer, so it keeps its map. If nothing changed,
+        *old* is kept.
+        """
+        new = self._store(lines)
+        if len(old) != len(new):
+            self._journal(('replace', old, new))
+            self.buffer = new
+            return sum(map(operator.ne, old, new))
+        mask = bytearray(map(operator.ne, old, new))
+        idx = array.array('q', itertools.compress(itertools.count(), mask))
+        if 3 * len(idx) > len(new):
+            self._journal(('replace', old, new))
+        else:
+            news = list(itertools.compress(new, mask))
+            if idx:
+                self._journal(('set', idx, list(itertools.compress(old, mask)),
+                               news))
+            if isinstance(old, MappedLines):
+                old.splice(idx, news)
+                new = old
+            elif isinstance(old, ChunkedLines) or not idx:
+                for where, line in zip(idx, news):
+                    old[where] = line
+                new = old
+        self.buffer = new
+        return len(idx)
+
+    # -------------------------------------------------------------------------
+    def _write(self, out, nl):
+        """
+        Write the buffer to file *out*, each line followed by *nl*
+        """
+        if hasattr(self.buffer, 'write'):
+            self.buffer.write(out, nl)
+        else:
+            _write_lines(out, self.buffer, nl, self.write_size)
+
+
+# -----------------------------------------------------------------------------
+def pipeline(lines, stages):
+    """
+    Chain each of *stages* onto the iterable *lines* and return an iterator
+    over the result. Each stage is a tuple whose first element names the
+    operation and whose remaining elements are its arguments:
+
+        ('sub', rgx, repl, count, literal)
+        ('sub_many', [(rgx, repl), ...], literal)
+        ('delete', rgx, removed, literal)   # removed lines go on *removed*
+        ('append', line)
+        ('insert', line, where)
+
+    Nothing is read from *lines* until the result is iterated, and only
+    insert() with a negative *where* holds more than one line at a time.
+    """
+    for stage in stages:
+        lines = _stage[stage[0]](lines, *stage[1:])
+    return lines
+
+
+# -----------------------------------------------------------------------------
+def _alternative(rgx):
+    """
+    Return the text of *rgx* for use as one branch of a larger pattern. The
+    flags of a compiled pattern are kept by scoping them to the branch.
+    """
+    if not isinstance(rgx, _Pattern):
+        return _as_text(rgx)
+    letters = "".join(c for c, flag in _SCOPED if rgx.flags & flag)
+    if not letters:
+        return _as_text(rgx.pattern)
+    return "(?{0}:{1})".format(letters, _as_text(rgx.pattern))
+
+
+_SCOPED = (('i', re.IGNORECASE), ('m', re.MULTILINE), ('s', re.DOTALL),
+           ('x', re.VERBOSE))
+
+
+# -----------------------------------------------------------------------------
+def _as_text(pattern):
+    """
+    Return bytes *pattern* as a str holding one character per byte, so that
+    it can be examined and combined as str patterns are. Anything else is
+    returned unchanged.
+    """
+    if isinstance(pattern, bytes):
+        return pattern.decode('latin-1')
+    return pattern
+
+
+# -----------------------------------------------------------------------------
+def _background(func, *args):
+    """
+    Run func(*args) in a pool of worker threads shared by all editor objects
+    and return a concurrent.futures.Future for the result
+    """
+    global _executor
+    if _executor is None:
+        import concurrent.futures
+        _executor = concurrent.futures.ThreadPoolExecutor(
+            thread_name_prefix="editor-backup")
+    return _executor.submit(func, *args)
+
+
+_executor = None
+
+
+# -----------------------------------------------------------------------------
+def _backup_compressed(src, dst, compress):
+    """
+    Write *src* to *dst* through the compressor module named *compress*, a
+    block at a time, then copy the metadata as shutil.copy2() would
+    """
+    module = importlib.import_module(compress)
+    with open(src, 'rb') as fsrc, module.open(dst, 'wb') as fdst:
+        shutil.copyfileobj(fsrc, fdst, 1 << 20)
+    shutil.copystat(src, dst)
+
+
+_compress_ext = {'bz2': '.bz2', 'gzip': '.gz', 'lzma': '.xz'}
+
+
+# -----------------------------------------------------------------------------
+def _backup_copyrange(src, dst):
+    """
+    Copy *src* to *dst* with os.copy_file_range(), which lets the kernel
+    (or a network filesystem's server) move the data without passing it
+    through user space, then copy the metadata as shutil.copy2() would
+    """
+    if not hasattr(os, 'copy_file_range'):
+        return shutil.copy2(src, dst)
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        try:
+            while os.copy_file_range(fsrc.fileno(), fdst.fileno(), 1 << 30):
+                pass
+        except OSError:
+            fsrc.seek(0)
+            fdst.seek(0)
+            fdst.truncate()
+            shutil.copyfileobj(fsrc, fdst)
+    shutil.copystat(src, dst)
+
+
+# -----------------------------------------------------------------------------
+def _backup_hardlink(src, dst):
+    """
+    Make *dst* another name for *src*, replacing any file already there.
+    Fall back to copying where hard links are not supported.
+    """
+    tmp = dst + ".tmp{0}".format(os.getpid())
+    try:
+        os.link(src, tmp)
+    except OSError:
+        return shutil.copy2(src, dst)
+    os.replace(tmp, dst)
+
+
+# -----------------------------------------------------------------------------
+def _backup_reflink(src, dst):
+    """
+    Clone *src* to *dst* with the FICLONE ioctl, so that the two share data
+    blocks until one of them is written. Fall back to _backup_copyrange()
+    where the platform or filesystem can't do that.
+    """
+    try:
+        import fcntl
+    except ImportError:
+        return _backup_copyrange(src, dst)
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        try:
+            fcntl.ioctl(fdst.fileno(), _FICLONE, fsrc.fileno())
+        except OSError:
+            fdst.close()
+            return _backup_copyrange(src, dst)
+    shutil.copystat(src, dst)
+
+
+_FICLONE = 0x40049409
+
+
+# -----------------------------------------------------------------------------
+def _backup_rename(src, dst):
+    """
+    Move *src* to *dst*, replacing any file already there
+    """
+    os.replace(src, dst)
+
+
+# -----------------------------------------------------------------------------
+def _byte_ranges(path, size):
+    """
+    Yield (start, stop) byte ranges that cover the file at *path* in pieces
+    of about *size* bytes, each ending at the end of a line
+    """
+    total = os.path.getsize(path)
+    with open(path, 'rb') as f:
+        start = 0
+        while start < total:
+            f.seek(min(start + size, total))
+            f.readline()
+            stop = min(f.tell(), total)
+            yield start, stop
+            start = stop
+
+
+# -----------------------------------------------------------------------------
+def _changed_ranges(old, new, i, j):
+    """
+    Return (i1, i2, j1, j2) tuples for the lines that differ between the
+    lists *old* and *new*, which start at lines *i* and *j* of the buffers
+    they came from: each run of changed lines if the lists are the same
+    length, or one range from the first difference to the last
+    """
+    if len(old) == len(new):
+        hits = itertools.compress(itertools.count(),
+                                  map(operator.ne, old, new))
+        rval = []
+        for _, run in itertools.groupby(enumerate(hits),
+                                        lambda x: x[1] - x[0]):
+            run = list(run)
+            start, stop = run[0][1], run[-1][1] + 1
+            rval.append((i + start, i + stop, j + start, j + stop))
+        return rval
+    same = itertools.takewhile(bool, map(operator.eq, old, new))
+    head = sum(1 for _ in same)
+    same = itertools.takewhile(bool, map(operator.eq, reversed(old[head:]),
+                                         reversed(new[head:])))
+    tail = sum(1 for _ in same)
+    return [(i + head, i + len(old) - tail, j + head, j + len(new) - tail)]
+
+
+# -----------------------------------------------------------------------------
+def _chunk_delete(lines, rgx, literal):
+    """
+    Return the lines of *lines* that don't match *rgx*, those that do, and
+    the indices of the latter
+    """
+    hits = list(_search(lines, rgx, literal))
+    return (list(itertools.compress(lines, map(operator.not_, hits))),
+            list(itertools.compress(lines, hits)),
+            array.array('q', itertools.compress(itertools.count(), hits)))
+
+
+# -----------------------------------------------------------------------------
+def _chunk_stream(path, start, stop, stages, newline, encoding, errors):
+    """
+    Read bytes *start* to *stop* of the file at *path* as lines, run them
+    through *stages*, and return the result with each line ending in
+    *newline*. The lines are decoded with *encoding* and *errors*, unless
+    *encoding* is None, in which case they are left as bytes.
+    """
+    with open(path, 'rb') as f:
+        f.seek(start)
+        data = f.read(stop - start)
+    if encoding is None:
+        lines = _read_lines(io.BytesIO(data), b"\r\n")
+    else:
+        lines = _read_lines(io.TextIOWrapper(io.BytesIO(data), encoding,
+                                             errors))
+    return newline[:0].join(x + newline for x in pipeline(lines, stages))
+
+
+# -----------------------------------------------------------------------------
+def _chunk_sub(lines, rgx, repl, count, literal):
+    """
+    Return *lines* with the substitution made and the number changed
+    """
+    new = list(_stage_sub(lines, rgx, repl, count, literal))
+    return new, sum(map(operator.ne, lines, new))
+
+
+# -----------------------------------------------------------------------------
+def _encoded_size(lines, newline, encoding, errors):
+    """
+    Return the number of bytes *lines* take up in a file when each is
+    followed by *newline* and encoded with *encoding* and *errors*. If
+    *encoding* is None, the lines are bytes already.
+    """
+    lines = map(operator.add, lines, itertools.repeat(newline))
+    if encoding is None:
+        return sum(map(len, lines))
+    return sum(map(len, map(str.encode, lines, itertools.repeat(encoding),
+                            itertools.repeat(errors))))
+
+
+# -----------------------------------------------------------------------------
+def _is_literal(rgx, repl=''):
+    """
+    Return True if *rgx* is a non-empty string (or bytes) with no regex
+    metacharacters and *repl* is a string (or bytes) with no backslash
+    escapes, so that matching and replacing them as plain text gives the
+    same result as the regex engine would. A callable *repl* needs the
+    regex engine's match objects.
+    """
+    if not isinstance(repl, (str, bytes)):
+        return False
+    rgx, repl = _as_text(rgx), _as_text(repl)
+    return (isinstance(rgx, str) and rgx != '' and
+            _META.isdisjoint(rgx) and '\\' not in repl)
+
+
+_META = frozenset('.^$*+?{}[]\\|()')
+_lossless = (None, 'strict', 'surrogateescape', 'surrogatepass')
+
+
+# -----------------------------------------------------------------------------
+def _newlines(seen):
+    """
+    Return the set of line terminators *seen* the way io's newlines
+    attribute gives them: None for none, the terminator if there is one,
+    otherwise a tuple of them in the order '\\r', '\\n', '\\r\\n'
+    """
+    if len(seen) > 1:
+        return tuple(_ for _ in _newline_order if _ in seen)
+    return next(iter(seen), None)
+
+
+_newline_order = ('\r', b'\r', '\n', b'\n', '\r\n', b'\r\n')
+
+
+# -----------------------------------------------------------------------------
+def _parallel_stream(out, path, split, newline, workers, size, encoding,
+                     errors):
+    """
+    Write the file at *path* to *out*, run through the stages in *split* as
+    returned by _split_stages(), by handing byte ranges of about *size*
+    bytes to a pool of *workers* processes, which decode them with
+    *encoding* and *errors* (or not at all if *encoding* is None). Results
+    are written in order, with no more than 2 * *workers* ranges in flight.
+    """
+    stages, appended = split
+    import concurrent.futures
+    window = collections.deque()
+    with concurrent.futures.ProcessPoolExecutor(workers) as pool:
+        for start, stop in _byte_ranges(path, size):
+            window.append(pool.submit(_chunk_stream, path, start, stop,
+                                      stages, newline, encoding, errors))
+            if len(window) >= 2 * workers:
+                out.write(window.popleft().result())
+        while window:
+            out.write(window.popleft().result())
+    out.writelines(x + newline for x in appended)
+
+
+# -----------------------------------------------------------------------------
+def _prune(filepath, ext, current, keep, maxage):
+    """
+    Remove the backups of *filepath* beyond the newest *keep*, and those
+    older than *maxage* seconds (or a timedelta), sparing *current*, the
+    backup just made. Backups are recognized and dated by parsing the end
+    of each name in the directory, which is read with one os.scandir(), as
+    strftime format *ext*.
+    """
+    tdir, base = os.path.split(os.path.abspath(filepath))
+    current = os.path.basename(current)
+    if hasattr(maxage, 'total_seconds'):
+        maxage = maxage.total_seconds()
+    found = []
+    for entry in os.scandir(tdir):
+        if (not entry.name.startswith(base) or entry.name == base or
+                entry.name == current):
+            continue
+        stamp = entry.name[len(base):]
+        for suffix in _compress_ext.values():
+            if stamp.endswith(suffix):
+                stamp = stamp[:-len(suffix)]
+                break
+        try:
+            found.append((dt.strptime(stamp, ext), entry.name))
+        except ValueError:
+            continue
+    now = dt.now()
+    for idx, (when, name) in enumerate(sorted(found, reverse=True), 1):
+        if ((keep is not None and idx >= keep) or
+                (maxage is not None and
+                 (now - when).total_seconds() > maxage)):
+            os.unlink(os.path.join(tdir, name))
+
+
+# -----------------------------------------------------------------------------
+def _read_blocks(f, seen, size):
+    """
+    Read open file *f* *size* characters (bytes, for a binary file) at a
+    time and yield a list of the lines completed by each read, without
+    their terminators, closing *f* when done. The terminators found are
+    added to the set *seen*.
+
+    A text file must be opened with newline='', so that its terminators
+    are seen as they are. It is split the way universal newlines mode
+    would split it. A binary file is split on b'\\n' only, and b'\\r' at
+    the end of a line is dropped. Blocks that use nothing but '\\r\\n' are
+    split on it directly.
+    """
+    with f:
+        empty = f.read(0)
+        binary = isinstance(empty, bytes)
+        cr, lf = (b'\r', b'\n') if binary else ('\r', '\n')
+        crlf = cr + lf
+        tail = empty
+        while True:
+            block = f.read(size)
+            last = not block
+            block = tail + block
+            held = empty
+            if not last and block.endswith(cr):
+                # this may be the first half of a CR-LF
+                block, held = block[:-1], cr
+            strip = False
+            if cr not in block:
+                lines = block.split(lf)
+                if len(lines) > 1:
+                    seen.add(lf)
+            else:
+                lines = block.split(crlf)
+                ncrlf = len(lines) - 1
+                nlf = block.count(lf) - ncrlf
+                lone = block.count(cr) - ncrlf
+                if ncrlf:
+                    seen.add(crlf)
+                if nlf:
+                    seen.add(lf)
+                if lone and not binary:
+                    seen.add(cr)
+                    lines = _universal.split(block)
+                elif nlf or lone:
+                    lines, strip = block.split(lf), True
+            tail = lines.pop() + held
+            if last and tail:
+                lines.append(tail)
+            if strip:
+                lines = [x.rstrip(cr) for x in lines]
+            yield lines
+            if last:
+                return
+
+
+_universal = re.compile('\r\n|\r|\n')
+
+
+# -----------------------------------------------------------------------------
+def _read_lines(f, strip="\r\n"):
+    """
+    Yield the lines of open file *f* without their terminators (the
+    characters in *strip*, which must be bytes if *f* is a binary file),
+    closing *f* when done
+    """
+    with f:
+        for line in f:
+            yield line.rstrip(strip)
+
+
+# -----------------------------------------------------------------------------
+def _regex(rgx, flags=0):
+    """
+    Return *rgx* as a compiled pattern with *flags* set. Patterns that are
+    already compiled are returned unchanged if they have *flags*. Strings
+    are compiled once and cached.
+    """
+    if isinstance(rgx, _Pattern):
+        if rgx.flags & flags == flags:
+            return rgx
+        return _compile(rgx.pattern, rgx.flags | flags)
+    return _compile(rgx, flags)
+
+
+_Pattern = type(re.compile(''))
+_compile = functools.lru_cache(maxsize=256)(re.compile)
+
+
+# -----------------------------------------------------------------------------
+def _search(lines, rgx, literal=None):
+    """
+    Return an iterator telling, for each of *lines*, whether *rgx* matches
+    it
+    """
+    if literal is None:
+        literal = _is_literal(rgx)
+    if not literal:
+        return map(_regex(rgx).search, lines)
+    rgx = getattr(rgx, 'pattern', rgx)
+    if isinstance(rgx, bytes):
+        # the in operator is slow on bytes; count() is quicker even though
+        # it finds every match
+        return map(bytes.count, lines, itertools.repeat(rgx))
+    return map(operator.contains, lines, itertools.repeat(rgx))
+
+
+# -----------------------------------------------------------------------------
+def _sniff(path, binary):
+    """
+    Return a set holding the terminator of the first line of the file at
+    *path*, b'\\n' or b'\\r\\n' (decoded unless *binary* is True), or an
+    empty set if the first 64KiB hold no b'\\n'
+    """
+    with open(path, 'rb') as f:
+        head = f.read(1 << 16)
+    end = head.find(b'\n')
+    if end < 0:
+        return set()
+    nl = b'\r\n' if head[end - 1:end] == b'\r' else b'\n'
+    return set([nl if binary else nl.decode('ascii')])
+
+
+# -----------------------------------------------------------------------------
+def _split_stages(stages):
+    """
+    If *stages* are 'sub', 'sub_many', and 'delete' stages, which work on
+    each line by itself, followed by nothing but 'append' stages, return
+    (line stages, appended lines). Otherwise, return None.
+    """
+    kinds = [x[0] for x in stages]
+    tail = len(kinds)
+    while tail and kinds[tail - 1] == 'append':
+        tail -= 1
+    if not set(kinds[:tail]) <= set(['delete', 'sub', 'sub_many']):
+        return None
+    return stages[:tail], [x[1] for x in stages[tail:]]
+
+
+# -----------------------------------------------------------------------------
+def _stage_append(lines, line):
+    """
+    Pass *lines* through, then *line*
+    """
+    return itertools.chain(lines, [line])
+
+
+# -----------------------------------------------------------------------------
+def _stage_delete(lines, rgx, removed, literal):
+    """
+    Drop the lines that match *rgx*, collecting them on *removed* if it is
+    not None
+    """
+    lines, probe = itertools.tee(lines)
+    hits = _search(probe, rgx, literal)
+    if removed is None:
+        return itertools.compress(lines, map(operator.not_, hits))
+    return _stage_delete_keep(lines, hits, removed)
+
+
+# -----------------------------------------------------------------------------
+def _stage_delete_keep(lines, hits, removed):
+    """
+    Drop the lines for which *hits* is true, adding them to *removed*
+    """
+    for line, hit in zip(lines, hits):
+        if hit:
+            removed.append(line)
+        else:
+            yield line
+
+
+# -----------------------------------------------------------------------------
+def _stage_insert(lines, line, where):
+    """
+    Pass *lines* through with *line* inserted the way list.insert(*where*,
+    *line*) would put it
+    """
+    if 0 <= where:
+        lines = iter(lines)
+        return itertools.chain(itertools.islice(lines, where), [line], lines)
+    return _stage_insert_tail(lines, line, -where)
+
+
+# -----------------------------------------------------------------------------
+def _stage_insert_tail(lines, line, back):
+    """
+    Insert *line* *back* lines before the end of *lines*. Only the last
+    *back* lines are held.
+    """
+    held = collections.deque(maxlen=back)
+    for item in lines:
+        if len(held) == back:
+            yield held[0]
+        held.append(item)
+    yield line
+    for item in held:
+        yield item
+
+
+# -----------------------------------------------------------------------------
+def _stage_sub(lines, rgx, repl, count, literal):
+    """
+    Replace matches of *rgx* with *repl* in each of *lines*
+    """
+    if literal is None:
+        literal = _is_literal(rgx, repl)
+    if not literal:
+        rsub = _regex(rgx).sub
+        return (rsub(repl, x, count) for x in lines)
+    rgx = getattr(rgx, 'pattern', rgx)
+    count = count or -1
+    if isinstance(rgx, bytes):
+        # bytes.replace() gives back the line itself when there is nothing
+        # to replace, and is quicker than asking the slow in operator first
+        return (x.replace(rgx, repl, count) for x in lines)
+    return (x.replace(rgx, repl, count) if rgx in x else x for x in lines)
+
+
+# -----------------------------------------------------------------------------
+def _stage_sub_many(lines, pairs, literal):
+    """
+    Apply each (rgx, repl) of *pairs* to each of *lines* in a single scan
+    """
+    if not pairs:
+        return iter(lines)
+    alts, table = [], {}
+    for idx, (rgx, repl) in enumerate(pairs):
+        name = "_{0}".format(idx)
+        if literal:
+            rgx = re.escape(getattr(rgx, 'pattern', rgx))
+        alts.append("(?P<{0}>{1})".format(name, _alternative(rgx)))
+        table[name] = repl
+    combined = "|".join(alts)
+    if isinstance(getattr(pairs[0][0], 'pattern', pairs[0][0]), bytes):
+        combined = combined.encode('latin-1')
+    rsub = _regex(combined).sub
+
+    def replace(match):
+        return table[match.lastgroup]
+    return (rsub(replace, x) for x in lines)
+
+
+# -----------------------------------------------------------------------------
+def _undelete(lines, idx, removed):
+    """
+    Put each of *removed* back into *lines* at the matching index in *idx*,
+    which is ascending and counts the lines as they were before the delete
+    """
+    lines = iter(lines)
+    prev = 0
+    for where, line in zip(idx, removed):
+        yield from itertools.islice(lines, where - prev)
+        yield line
+        prev = where + 1
+    yield from lines
+
+
+# -----------------------------------------------------------------------------
+def _write_lines(out, lines, newline, size):
+    """
+    Write *lines* to *out*, each followed by *newline*, joined into pieces
+    of about *size* characters (bytes, for bytes lines). Only one piece is
+    held at a time, and the number of lines in the next is chosen from the
+    length of the last.
+    """
+    lines = iter(lines)
+    count = 1024
+    while True:
+        batch = list(itertools.islice(lines, count))
+        if not batch:
+            return
+        batch.append(newline[:0])
+        text = newline.join(batch)
+        del batch
+        out.write(text)
+        count = max(1, count * size // len(text))
+
+
+_stage = {'append': _stage_append,
+          'delete': _stage_delete,
+          'insert': _stage_insert,
+          'sub': _stage_sub,
+          'sub_many': _stage_sub_many}
+
+
+_backup_method = {'copy': shutil.copy2,
+                  'copyrange': _backup_copyrange,
+                  'hardlink': _backup_hardlink,
+                  'reflink': _backup_reflink,
+                  'rename': _backup_rename}
+
+
+_storage = {'chunked': ChunkedLines,
+            'compact': CompactLines,
+            'mmap': MappedLines,
+            'list': list}
+
 
 # -----------------------------------------------------------------------------
 class Error(Exception):
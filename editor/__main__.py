@@ -0,0 +1,201 @@
+"""
+Edit files, or standard input, from the command line:
+
+    python -m editor [options] [file ...]
+
+The edits given by --sub, --delete, --append, and --insert are applied in
+the order they appear on the command line. With no files (or '-'),
+standard input is edited a line at a time to standard output. Otherwise
+each file is edited in place and backed up as the backup options say.
+With --binary, patterns, replacements, and lines are taken as bytes (as
+os.fsencode() makes them) and nothing is decoded.
+"""
+import argparse
+import os
+import sys
+
+import editor
+
+
+# -----------------------------------------------------------------------------
+class _Step(argparse.Action):
+    """
+    Add an edit, named by *const*, to the script in the order the options
+    appear on the command line
+    """
+    # -------------------------------------------------------------------------
+    def __call__(self, parser, namespace, values, option_string=None):
+        """
+        Append (name, values...) to namespace.script
+        """
+        values = values if isinstance(values, list) else [values]
+        if self.const == 'insert':
+            try:
+                values = [values[1], int(values[0])]
+            except ValueError:
+                parser.error("{0}: '{1}' is not a line number".format(
+                    option_string, values[0]))
+        script = list(getattr(namespace, self.dest) or [])
+        script.append(tuple([self.const] + values))
+        setattr(namespace, self.dest, script)
+
+
+_newlines = {'cr': '\r', 'crlf': '\r\n', 'lf': '\n'}
+
+
+# -----------------------------------------------------------------------------
+def main(argv=None):
+    """
+    Run the command line in *argv* (sys.argv[1:] by default) and return the
+    exit status: 0 if every file was edited, 1 if any failed
+    """
+    parser = _parser()
+    args = parser.parse_args(argv)
+    if not args.script:
+        parser.error("no edits given")
+    literal = True if args.fixed else None
+    nl = _newlines.get(args.newline)
+    steps = args.script
+    if args.binary:
+        nl = nl and nl.encode('ascii')
+        steps = [x[:1] + tuple(os.fsencode(_) if isinstance(_, str) else _
+                               for _ in x[1:]) for x in steps]
+    paths = [x for x in args.files if x != '-']
+    if len(paths) < len(args.files) or not args.files:
+        if args.binary:
+            stdin, stdout = sys.stdin.buffer, sys.stdout.buffer
+            lines = editor._read_lines(stdin, b"\r\n")
+            end = nl or b"\n"
+        else:
+            stdin, stdout = sys.stdin, sys.stdout
+            if args.encoding or args.errors:
+                for stream in (stdin, stdout):
+                    stream.reconfigure(encoding=args.encoding,
+                                       errors=args.errors)
+            lines = editor._read_lines(stdin)
+            end = nl or "\n"
+        stages = [_stage(x, literal) for x in steps]
+        stdout.writelines(x + end for x in editor.pipeline(lines, stages))
+        stdout.flush()
+    if not paths:
+        return 0
+
+    script = [_step(x, literal, args.workers) for x in steps]
+    backup = list(args.backup)
+    options = {}
+    for key in ['compress', 'keep', 'maxage', 'store']:
+        if getattr(args, key) is not None:
+            options[key] = getattr(args, key)
+    if options:
+        backup.append(options)
+    from editor.multi import edit_files
+    rval = 0
+    for res in edit_files(paths, script, workers=args.jobs,
+                          backup=tuple(backup) or None, newline=nl,
+                          stream=args.stream, binary=args.binary,
+                          encoding=args.encoding, errors=args.errors):
+        if res.error is not None:
+            sys.stderr.write("editor: {0}: {1}\n".format(res.path,
+                                                         res.error))
+            rval = 1
+        elif args.verbose and res.changed:
+            sys.stderr.write("editor: {0}: changed\n".format(res.path))
+        elif args.verbose and res.changed is None:
+            sys.stderr.write("editor: {0}: rewritten\n".format(res.path))
+    return rval
+
+
+# -----------------------------------------------------------------------------
+def _parser():
+    """
+    Return the argument parser
+    """
+    p = argparse.ArgumentParser(prog="python -m editor",
+                                description="Edit files in place, or "
+                                "standard input to standard output.")
+    p.add_argument('files', nargs='*', metavar='FILE',
+                   help="files to edit in place ('-' for standard input)")
+    edits = p.add_argument_group("edits, applied in the order given")
+    edits.add_argument('-s', '--sub', nargs=2, metavar=('RGX', 'REPL'),
+                       dest='script', action=_Step, const='sub',
+                       help="replace matches of RGX with REPL")
+    edits.add_argument('-d', '--delete', metavar='RGX', dest='script',
+                       action=_Step, const='delete',
+                       help="delete lines that match RGX")
+    edits.add_argument('-a', '--append', metavar='LINE', dest='script',
+                       action=_Step, const='append',
+                       help="add LINE at the end")
+    edits.add_argument('-i', '--insert', nargs=2, metavar=('WHERE', 'LINE'),
+                       dest='script', action=_Step, const='insert',
+                       help="insert LINE before line number WHERE, "
+                       "counting from 0 (negative counts from the end)")
+    edits.add_argument('-F', '--fixed', action='store_true',
+                       help="patterns are plain text, not regexes")
+    files = p.add_argument_group("file options")
+    files.add_argument('-b', '--backup', action='append', default=[],
+                       metavar='SPEC',
+                       help="'load', 'noappend', 'background', a method "
+                       "('rename', 'hardlink', 'reflink', 'copyrange'), "
+                       "or a strftime extension for the backup name; "
+                       "may be repeated")
+    files.add_argument('--keep', type=int, metavar='N',
+                       help="keep only the N newest backups")
+    files.add_argument('--max-age', type=float, dest='maxage',
+                       metavar='SECS',
+                       help="remove backups older than SECS seconds")
+    files.add_argument('--compress', choices=['bz2', 'gzip', 'lzma'],
+                       help="compress backups")
+    files.add_argument('--store', metavar='DIR',
+                       help="keep backups in a deduplicating store in DIR")
+    files.add_argument('-n', '--newline', choices=sorted(_newlines),
+                       help="line terminator to write (default: the one the "
+                       "file uses, or lf)")
+    files.add_argument('--binary', action='store_true',
+                       help="edit the files as bytes, without decoding them")
+    files.add_argument('-e', '--encoding', metavar='NAME',
+                       help="text encoding of the files (default: the "
+                       "locale's)")
+    files.add_argument('--errors', metavar='HANDLER',
+                       help="how to handle encoding errors, as open() does "
+                       "('strict', 'surrogateescape', 'replace', ...)")
+    files.add_argument('--stream', action='store_true',
+                       help="edit files a line at a time, without loading "
+                       "them")
+    files.add_argument('-j', '--jobs', type=int, default=1, metavar='N',
+                       help="edit up to N files at once in worker processes "
+                       "(0 for one per CPU)")
+    files.add_argument('-w', '--workers', type=int, metavar='N',
+                       help="split the edits of each file among N "
+                       "processes")
+    files.add_argument('-v', '--verbose', action='store_true',
+                       help="report the files changed (with --stream, the "
+                       "files rewritten)")
+    return p
+
+
+# -----------------------------------------------------------------------------
+def _stage(step, literal):
+    """
+    Turn a script *step* into a pipeline stage
+    """
+    if step[0] == 'sub':
+        return step + (0, literal)
+    elif step[0] == 'delete':
+        return step + (None, literal)
+    return step
+
+
+# -----------------------------------------------------------------------------
+def _step(step, literal, workers):
+    """
+    Turn a script *step* into a call of the editor method it names
+    """
+    if step[0] == 'sub':
+        return step + (0, literal, False, workers)
+    elif step[0] == 'delete':
+        return step + (literal, workers)
+    return step
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,110 @@
+"""
+An asyncio front end for editor
+"""
+import asyncio
+import functools
+
+import editor
+
+
+# -----------------------------------------------------------------------------
+class AsyncEditor(object):
+    """
+    Wrap an editor object so that loading, saving, and backups run in an
+    executor rather than on the event loop:
+
+        q = await AsyncEditor('/path/to/file').load()
+        q.sub('foo', 'bar')
+        await q.quit()
+
+    The in-memory operations (sub(), delete(), append(), insert(),
+    batch(), changed(), ...) and buffer are those of the wrapped editor,
+    which is available as q.editor once load() has finished.
+
+    *executor* is the concurrent.futures executor to use, by default the
+    event loop's. Passing one ThreadPoolExecutor(max_workers=N) to many
+    AsyncEditor objects limits how many of them read or write files at the
+    same time.
+    """
+    # -------------------------------------------------------------------------
+    def __init__(self, filepath=None, executor=None, **kwargs):
+        """
+        Remember *filepath* and the editor constructor arguments *kwargs* for
+        load()
+        """
+        self.filepath = filepath
+        self.executor = executor
+        self.editor = None
+        self._kwargs = kwargs
+
+    # -------------------------------------------------------------------------
+    def __getattr__(self, name):
+        """
+        Pass anything not defined here on to the editor object
+        """
+        return getattr(self._require(name), name)
+
+    # -------------------------------------------------------------------------
+    @property
+    def buffer(self):
+        """
+        The lines of the editor object
+        """
+        return self._require('buffer').buffer
+
+    # -------------------------------------------------------------------------
+    @buffer.setter
+    def buffer(self, lines):
+        """
+        Replace the lines of the editor object
+        """
+        self._require('buffer').buffer = lines
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    async def contents(filepath, executor=None, **kwargs):
+        """
+        Read a file in *executor* and return its contents as a list, as
+        editor.contents() does with *kwargs* (encoding, errors, binary)
+        """
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(executor, functools.partial(
+            editor.editor.contents, filepath, **kwargs))
+
+    # -------------------------------------------------------------------------
+    async def load(self):
+        """
+        Create the editor object, which reads the file and makes any load
+        time backup, in the executor. Return self.
+        """
+        self.editor = await self._run(editor.editor, self.filepath,
+                                      **self._kwargs)
+        return self
+
+    # -------------------------------------------------------------------------
+    async def quit(self, save=True, filepath=None, backup=None, newline=None):
+        """
+        Run editor.quit() in the executor and return what it returns
+        """
+        return await self._run(self._require('quit()').quit, save,
+                               filepath, backup, newline)
+
+    # -------------------------------------------------------------------------
+    def _require(self, what):
+        """
+        Return the editor object, complaining that *what* needs it if load()
+        has not made it yet
+        """
+        rval = self.__dict__.get('editor')
+        if rval is None:
+            raise editor.Error("{0} needs load() first".format(what))
+        return rval
+
+    # -------------------------------------------------------------------------
+    def _run(self, func, *args, **kwargs):
+        """
+        Return a future for func(*args, **kwargs) run in the executor
+        """
+        loop = asyncio.get_event_loop()
+        return loop.run_in_executor(self.executor,
+                                    functools.partial(func, *args, **kwargs))
@@ -0,0 +1,1041 @@
+"""
+Alternative containers for the lines of an editor buffer
+"""
+try:
+    from collections.abc import MutableSequence
+except ImportError:
+    from collections import MutableSequence
+import array
+import bisect
+import codecs
+import itertools
+import locale
+import mmap
+import operator
+import os
+
+
+# -----------------------------------------------------------------------------
+class ChunkedLines(MutableSequence):
+    """
+    A list of lines held as a sequence of chunks of up to 2 * *chunksize*
+    lines each. A Fenwick tree over the chunk lengths finds the chunk
+    holding any position in O(log n), so inserting or deleting a line in
+    the middle only moves the lines in one chunk instead of everything
+    after it. Chunks are split when they grow too long and dropped when
+    they empty, which reindexes the O(n / chunksize) chunk lengths.
+
+    copy() shares the chunks with the copy, and each side duplicates a
+    shared chunk the first time it changes it, so a copy costs time and
+    memory for the list of chunks only.
+
+    Apart from speed, it behaves like a list.
+    """
+    chunksize = 512
+
+    # -------------------------------------------------------------------------
+    def __init__(self, lines=()):
+        """
+        Build the chunks from the iterable *lines*
+        """
+        self._load(lines)
+
+    # -------------------------------------------------------------------------
+    def __delitem__(self, index):
+        """
+        Remove the line (or slice of lines) at *index*
+        """
+        if isinstance(index, slice):
+            lines = list(self)
+            del lines[index]
+            self._load(lines)
+            return
+        cdx, off = self._locate(self._position(index))
+        chunk = self._own(cdx)
+        del chunk[off]
+        self._len -= 1
+        if chunk:
+            self._update(cdx, -1)
+        else:
+            del self._chunks[cdx]
+            del self._owned[cdx]
+            self._reindex()
+
+    # -------------------------------------------------------------------------
+    def __eq__(self, other):
+        """
+        Compare equal to any list or sequence of lines holding the same
+        lines in the same order
+        """
+        if not isinstance(other, (list, tuple, MutableSequence)):
+            return NotImplemented
+        return (len(self) == len(other) and
+                all(map(operator.eq, self, other)))
+
+    # -------------------------------------------------------------------------
+    def __ne__(self, other):
+        """
+        Python 2 does not derive != from ==
+        """
+        rval = self.__eq__(other)
+        return rval if rval is NotImplemented else not rval
+
+    # -------------------------------------------------------------------------
+    def __getitem__(self, index):
+        """
+        Return the line at *index*, or a list of the lines in slice *index*
+        """
+        if isinstance(index, slice):
+            start, stop, step = index.indices(self._len)
+            if step != 1:
+                return [self[_] for _ in range(start, stop, step)]
+            elif stop <= start:
+                return []
+            cdx, off = self._locate(start)
+            lines = itertools.chain.from_iterable(
+                itertools.islice(self._chunks, cdx, None))
+            return list(itertools.islice(lines, off, off + stop - start))
+        cdx, off = self._locate(self._position(index))
+        return self._chunks[cdx][off]
+
+    # -------------------------------------------------------------------------
+    def __iter__(self):
+        """
+        Iterate over the lines
+        """
+        return itertools.chain.from_iterable(self._chunks)
+
+    # -------------------------------------------------------------------------
+    def __len__(self):
+        """
+        Return the number of lines
+        """
+        return self._len
+
+    # -------------------------------------------------------------------------
+    def __repr__(self):
+        """
+        Show the lines the way a list would
+        """
+        return "{0}({1!r})".format(type(self).__name__, list(self))
+
+    # -------------------------------------------------------------------------
+    def __setitem__(self, index, value):
+        """
+        Replace the line (or slice of lines) at *index*
+        """
+        if isinstance(index, slice):
+            lines = list(self)
+            lines[index] = value
+            self._load(lines)
+            return
+        cdx, off = self._locate(self._position(index))
+        self._own(cdx)[off] = value
+
+    # -------------------------------------------------------------------------
+    def append(self, value):
+        """
+        Add *value* at the end
+        """
+        self.insert(self._len, value)
+
+    # -------------------------------------------------------------------------
+    def copy(self):
+        """
+        Return a shallow copy that shares the chunks until either side
+        changes them
+        """
+        rval = type(self).__new__(type(self))
+        rval._chunks = list(self._chunks)
+        rval._len = self._len
+        rval._tree = list(self._tree)
+        rval._top = self._top
+        rval._owned = bytearray(len(self._chunks))
+        self._owned = bytearray(len(self._chunks))
+        return rval
+
+    # -------------------------------------------------------------------------
+    def extend(self, values):
+        """
+        Add the lines from *values* at the end
+        """
+        values = list(values)
+        if not values:
+            return
+        self._len += len(values)
+        step = self.chunksize
+        if self._chunks and len(self._chunks[-1]) < step:
+            room = step - len(self._chunks[-1])
+            self._own(len(self._chunks) - 1).extend(values[:room])
+            values = values[room:]
+        count = len(self._chunks)
+        self._chunks.extend(values[_:_ + step]
+                            for _ in range(0, len(values), step))
+        self._owned.extend(b"\x01" * (len(self._chunks) - count))
+        self._reindex()
+
+    # -------------------------------------------------------------------------
+    def insert(self, index, value):
+        """
+        Insert *value* before *index*, as list.insert() does
+        """
+        if index < 0:
+            index = max(0, index + self._len)
+        index = min(index, self._len)
+        if not self._chunks:
+            self._chunks.append([value])
+            self._owned = bytearray(b"\x01")
+            self._len = 1
+            self._reindex()
+            return
+        if index == self._len:
+            cdx = len(self._chunks) - 1
+            off = len(self._chunks[cdx])
+        else:
+            cdx, off = self._locate(index)
+        chunk = self._own(cdx)
+        chunk.insert(off, value)
+        self._len += 1
+        if len(chunk) <= 2 * self.chunksize:
+            self._update(cdx, 1)
+        else:
+            half = len(chunk) // 2
+            self._chunks[cdx:cdx + 1] = [chunk[:half], chunk[half:]]
+            self._owned[cdx:cdx + 1] = b"\x01\x01"
+            self._reindex()
+
+    # -------------------------------------------------------------------------
+    def matching_blocks(self, other):
+        """
+        Return a list of (i, j, n) triples, ascending in i and j, for the
+        runs of lines that this ChunkedLines and its copy *other* still
+        share, meaning self[i:i + n] == other[j:j + n]
+        """
+        return _matching_blocks(self._chunks, other._chunks, len)
+
+    # -------------------------------------------------------------------------
+    def _load(self, lines):
+        """
+        Replace the content with the lines from the iterable *lines*
+        """
+        lines = list(lines)
+        step = self.chunksize
+        self._chunks = [lines[_:_ + step] for _ in range(0, len(lines), step)]
+        self._owned = bytearray(b"\x01") * len(self._chunks)
+        self._len = len(lines)
+        self._reindex()
+
+    # -------------------------------------------------------------------------
+    def _locate(self, index):
+        """
+        Return (chunk number, offset in chunk) for line *index*, which must
+        be in range
+        """
+        tree = self._tree
+        pos, rem = 0, index
+        step = self._top
+        while step:
+            nxt = pos + step
+            if nxt < len(tree) and tree[nxt] <= rem:
+                pos = nxt
+                rem -= tree[nxt]
+            step >>= 1
+        return pos, rem
+
+    # -------------------------------------------------------------------------
+    def _own(self, cdx):
+        """
+        Return chunk *cdx*, first replacing it with a copy of its own if it
+        is shared with a copy of this ChunkedLines
+        """
+        if not self._owned[cdx]:
+            self._chunks[cdx] = list(self._chunks[cdx])
+            self._owned[cdx] = 1
+        return self._chunks[cdx]
+
+    # -------------------------------------------------------------------------
+    def _position(self, index):
+        """
+        Turn a possibly negative *index* into a position, raising IndexError
+        if it is out of range
+        """
+        if index < 0:
+            index += self._len
+        if not 0 <= index < self._len:
+            raise IndexError("line index out of range")
+        return index
+
+    # -------------------------------------------------------------------------
+    def _reindex(self):
+        """
+        Rebuild the Fenwick tree of chunk lengths
+        """
+        tree = [0] + [len(_) for _ in self._chunks]
+        for idx in range(1, len(tree)):
+            parent = idx + (idx & -idx)
+            if parent < len(tree):
+                tree[parent] += tree[idx]
+        self._tree = tree
+        self._top = 1 << (len(tree) - 1).bit_length() >> 1
+
+    # -------------------------------------------------------------------------
+    def _update(self, cdx, delta):
+        """
+        Adjust the length of chunk *cdx* by *delta* in the Fenwick tree
+        """
+        tree = self._tree
+        idx = cdx + 1
+        while idx < len(tree):
+            tree[idx] += delta
+            idx += idx & -idx
+
+
+# -----------------------------------------------------------------------------
+class CompactLines(MutableSequence):
+    """
+    A list of lines packed into blocks of *blocksize* lines. Each block is
+    a single string holding its lines joined by newlines plus an
+    array('q') of where each line starts, so a line costs its characters
+    plus nine bytes rather than a whole str object and a list slot. Line
+    objects are only built when they are read.
+
+    Lines appended at the end collect in an ordinary list until there are
+    enough of them to pack. Changing a line anywhere else repacks the
+    block that holds it.
+    """
+    blocksize = 65536
+
+    # -------------------------------------------------------------------------
+    def __init__(self, lines=()):
+        """
+        Pack the lines from the iterable *lines*
+        """
+        self._load(lines)
+
+    # -------------------------------------------------------------------------
+    def __delitem__(self, index):
+        """
+        Remove the line (or slice of lines) at *index*
+        """
+        if isinstance(index, slice):
+            lines = list(self)
+            del lines[index]
+            self._load(lines)
+            return
+        self._edit(index, lambda lines, off: lines.__delitem__(off))
+
+    # -------------------------------------------------------------------------
+    def __eq__(self, other):
+        """
+        Compare equal to any list or sequence of lines holding the same
+        lines in the same order
+        """
+        if not isinstance(other, (list, tuple, MutableSequence)):
+            return NotImplemented
+        return (len(self) == len(other) and
+                all(map(operator.eq, self, other)))
+
+    # -------------------------------------------------------------------------
+    def __ne__(self, other):
+        """
+        Python 2 does not derive != from ==
+        """
+        rval = self.__eq__(other)
+        return rval if rval is NotImplemented else not rval
+
+    # -------------------------------------------------------------------------
+    def __getitem__(self, index):
+        """
+        Return the line at *index*, or a list of the lines in slice *index*
+        """
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            if step != 1:
+                return [self[_] for _ in range(start, stop, step)]
+            elif stop <= start:
+                return []
+            bdx = min(bisect.bisect_right(self._starts, start) - 1,
+                      len(self._blocks))
+            blocks = map(self._unpack, range(bdx, len(self._blocks)))
+            lines = itertools.chain(itertools.chain.from_iterable(blocks),
+                                    self._tail)
+            off = start - self._starts[bdx]
+            return list(itertools.islice(lines, off, off + stop - start))
+        index = self._position(index)
+        packed = self._starts[-1]
+        if packed <= index:
+            return self._tail[index - packed]
+        bdx = bisect.bisect_right(self._starts, index) - 1
+        text, offsets, _ = self._blocks[bdx]
+        off = index - self._starts[bdx]
+        return text[offsets[off]:offsets[off + 1] - 1]
+
+    # -------------------------------------------------------------------------
+    def __iter__(self):
+        """
+        Iterate over the lines, unpacking one block at a time
+        """
+        blocks = map(self._unpack, range(len(self._blocks)))
+        return itertools.chain(itertools.chain.from_iterable(blocks),
+                               self._tail)
+
+    # -------------------------------------------------------------------------
+    def __len__(self):
+        """
+        Return the number of lines
+        """
+        return self._starts[-1] + len(self._tail)
+
+    # -------------------------------------------------------------------------
+    def __repr__(self):
+        """
+        Show the lines the way a list would
+        """
+        return "{0}({1!r})".format(type(self).__name__, list(self))
+
+    # -------------------------------------------------------------------------
+    def __setitem__(self, index, value):
+        """
+        Replace the line (or slice of lines) at *index*
+        """
+        if isinstance(index, slice):
+            lines = list(self)
+            lines[index] = value
+            self._load(lines)
+            return
+        self._edit(index, lambda lines, off: lines.__setitem__(off, value))
+
+    # -------------------------------------------------------------------------
+    def append(self, value):
+        """
+        Add *value* at the end
+        """
+        self._tail.append(value)
+        if len(self._tail) >= self.blocksize:
+            self._blocks.append(_pack(self._tail))
+            self._tail = []
+            self._reindex()
+
+    # -------------------------------------------------------------------------
+    def copy(self):
+        """
+        Return a copy. Packed blocks are never changed in place, so the copy
+        shares them.
+        """
+        rval = type(self).__new__(type(self))
+        rval._blocks = list(self._blocks)
+        rval._starts = self._starts
+        rval._tail = list(self._tail)
+        return rval
+
+    # -------------------------------------------------------------------------
+    def insert(self, index, value):
+        """
+        Insert *value* before *index*, as list.insert() does
+        """
+        if index < 0:
+            index = max(0, index + len(self))
+        if self._starts[-1] <= index:
+            self._tail.insert(index - self._starts[-1], value)
+            return
+        self._edit(index, lambda lines, off: lines.insert(off, value))
+
+    # -------------------------------------------------------------------------
+    def matching_blocks(self, other):
+        """
+        Return a list of (i, j, n) triples, ascending in i and j, for the
+        runs of packed lines that this CompactLines and its copy *other*
+        still share, meaning self[i:i + n] == other[j:j + n]
+        """
+        return _matching_blocks(self._blocks, other._blocks,
+                                lambda block: len(block[1]) - 1)
+
+    # -------------------------------------------------------------------------
+    def write(self, out, newline='\n'):
+        """
+        Write the lines to file object *out*, each followed by *newline*.
+        Blocks whose lines hold no newlines of their own go out as they are
+        packed, without being split into lines.
+        """
+        for bdx, (text, _, plain) in enumerate(self._blocks):
+            sep = _newline([text])
+            if plain and newline == sep:
+                out.write(text)
+            elif plain:
+                out.write(text.replace(sep, newline))
+            else:
+                out.write(newline.join(self._unpack(bdx)) + newline)
+        if self._tail:
+            out.write(newline.join(self._tail) + newline)
+
+    # -------------------------------------------------------------------------
+    def _edit(self, index, change):
+        """
+        Unpack the block holding line *index*, call change(lines, offset) on
+        its lines, and pack the result back into one or two blocks (or none)
+        """
+        index = self._position(index)
+        packed = self._starts[-1]
+        if packed <= index:
+            change(self._tail, index - packed)
+            return
+        bdx = bisect.bisect_right(self._starts, index) - 1
+        lines = self._unpack(bdx)
+        change(lines, index - self._starts[bdx])
+        step = self.blocksize
+        self._blocks[bdx:bdx + 1] = [_pack(lines[_:_ + step])
+                                     for _ in range(0, len(lines), step)]
+        self._reindex()
+
+    # -------------------------------------------------------------------------
+    def _load(self, lines):
+        """
+        Replace the content with the lines from the iterable *lines*,
+        packing them a block at a time
+        """
+        self._blocks = []
+        self._tail = []
+        lines = iter(lines)
+        while True:
+            batch = list(itertools.islice(lines, self.blocksize))
+            if len(batch) < self.blocksize:
+                self._tail = batch
+                break
+            self._blocks.append(_pack(batch))
+        self._reindex()
+
+    # -------------------------------------------------------------------------
+    def _position(self, index):
+        """
+        Turn a possibly negative *index* into a position, raising IndexError
+        if it is out of range
+        """
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("line index out of range")
+        return index
+
+    # -------------------------------------------------------------------------
+    def _reindex(self):
+        """
+        Rebuild the table of the first line number in each block
+        """
+        counts = [len(offsets) - 1 for _, offsets, _ in self._blocks]
+        self._starts = array.array('q', itertools.accumulate([0] + counts))
+
+    # -------------------------------------------------------------------------
+    def _unpack(self, bdx):
+        """
+        Return the lines of block *bdx* as a list
+        """
+        text, offsets, plain = self._blocks[bdx]
+        if plain:
+            return text[:-1].split(_newline([text]))
+        return [text[offsets[_]:offsets[_ + 1] - 1]
+                for _ in range(len(offsets) - 1)]
+
+
+# -----------------------------------------------------------------------------
+def _matching_blocks(old, new, size):
+    """
+    Return (i, j, n) triples for the pieces of the list *new* that are the
+    very objects found in the list *old*, in order, merging runs of them.
+    size(piece) gives the number of lines in a piece.
+    """
+    where = {}
+    start = 0
+    for piece in old:
+        where[id(piece)] = start
+        start += size(piece)
+    rval = []
+    last = start = 0
+    for piece in new:
+        count = size(piece)
+        i = where.get(id(piece), -1)
+        if last <= i:
+            prev = rval[-1] if rval else (-1, -1, 0)
+            if (prev[0] + prev[2], prev[1] + prev[2]) == (i, start):
+                rval[-1] = (prev[0], prev[1], prev[2] + count)
+            else:
+                rval.append((i, start, count))
+            last = i + count
+        start += count
+    return rval
+
+
+# -----------------------------------------------------------------------------
+def _newline(lines):
+    """
+    Return the newline that goes with the type of *lines*, str or bytes
+    """
+    if lines and isinstance(lines[0], bytes):
+        return b'\n'
+    return '\n'
+
+
+# -----------------------------------------------------------------------------
+def _pack(lines):
+    """
+    Pack the non-empty list *lines* into (text, offsets, plain). *text* is
+    the lines joined and terminated by newlines, *offsets* holds where each
+    line starts plus where the next one would, and *plain* is True if no
+    line holds a newline of its own.
+    """
+    sep = _newline(lines)
+    text = sep.join(lines) + sep
+    sizes = map(operator.add, map(len, lines), itertools.repeat(1))
+    offsets = array.array('q', itertools.accumulate(itertools.chain([0],
+                                                                    sizes)))
+    return text, offsets, text.count(sep) == len(lines)
+
+
+# -----------------------------------------------------------------------------
+class MappedLines(MutableSequence):
+    """
+    The lines of a file, read on demand through a read-only memory map.
+    Nothing is decoded at load time. An index of where each line starts is
+    built only as far as the lines asked for, and len() counts newlines in
+    large blocks without indexing them.
+
+    The content is kept as a list of pieces, each either a (start, stop)
+    range of line numbers in the mapped file (stop None means to the end
+    of the file) or a list of lines added since load. Changing a line
+    splits the range around it, so editing the top of a huge file touches
+    only the first few lines, and write() copies the untouched ranges
+    straight from the map.
+
+    The mapped file must not be truncated or rewritten in place while the
+    map is open; editor.quit() saves these buffers by writing a new file
+    and renaming it over the old one. Lines are split on '\\n' only, and a
+    trailing '\\r' is dropped. A file loaded in binary mode gives bytes
+    lines, which are not decoded at all.
+    """
+    blocksize = 1 << 20
+
+    # -------------------------------------------------------------------------
+    def __init__(self, lines=()):
+        """
+        Hold the lines from the iterable *lines*, with no file mapped
+        """
+        self._map = None
+        self._encoding = None
+        self._errors = 'strict'
+        self._offsets = array.array('q', [0])
+        self._total = 0
+        self._pieces = [list(lines)]
+
+    # -------------------------------------------------------------------------
+    def __delitem__(self, index):
+        """
+        Remove the line (or slice of lines) at *index*
+        """
+        if isinstance(index, slice):
+            lines = list(self)
+            del lines[index]
+            self._pieces = [lines]
+            return
+        self._split(self._position(index), [], 1)
+
+    # -------------------------------------------------------------------------
+    def __eq__(self, other):
+        """
+        Compare equal to any list or sequence of lines holding the same
+        lines in the same order
+        """
+        if not isinstance(other, (list, tuple, MutableSequence)):
+            return NotImplemented
+        return (len(self) == len(other) and
+                all(map(operator.eq, self, other)))
+
+    # -------------------------------------------------------------------------
+    def __ne__(self, other):
+        """
+        Python 2 does not derive != from ==
+        """
+        rval = self.__eq__(other)
+        return rval if rval is NotImplemented else not rval
+
+    # -------------------------------------------------------------------------
+    def __getitem__(self, index):
+        """
+        Return the line at *index*, or a list of the lines in slice *index*
+        """
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            if step == 1:
+                return list(itertools.islice(self, start, max(start, stop)))
+            return [self[_] for _ in range(start, stop, step)]
+        pdx, off = self._locate(self._position(index))
+        piece = self._pieces[pdx]
+        if isinstance(piece, list):
+            return piece[off]
+        return self._line(piece[0] + off)
+
+    # -------------------------------------------------------------------------
+    def __iter__(self):
+        """
+        Iterate over the lines, decoding the mapped ranges a block at a time
+        """
+        for piece in list(self._pieces):
+            if isinstance(piece, list):
+                for line in piece:
+                    yield line
+            else:
+                for line in self._read(*piece):
+                    yield line
+
+    # -------------------------------------------------------------------------
+    def __len__(self):
+        """
+        Return the number of lines
+        """
+        return sum(self._size(_) for _ in self._pieces)
+
+    # -------------------------------------------------------------------------
+    def __repr__(self):
+        """
+        Show the lines the way a list would
+        """
+        return "{0}({1!r})".format(type(self).__name__, list(self))
+
+    # -------------------------------------------------------------------------
+    def __setitem__(self, index, value):
+        """
+        Replace the line (or slice of lines) at *index*
+        """
+        if isinstance(index, slice):
+            lines = list(self)
+            lines[index] = value
+            self._pieces = [lines]
+            return
+        self._split(self._position(index), [value], 1)
+
+    # -------------------------------------------------------------------------
+    def append(self, value):
+        """
+        Add *value* at the end
+        """
+        if not isinstance(self._pieces[-1], list):
+            self._pieces.append([])
+        self._pieces[-1].append(value)
+
+    # -------------------------------------------------------------------------
+    def copy(self):
+        """
+        Return a copy that shares the map and its line index
+        """
+        rval = type(self).__new__(type(self))
+        rval.__dict__.update(self.__dict__)
+        rval._pieces = [list(_) if isinstance(_, list) else _
+                        for _ in self._pieces]
+        return rval
+
+    # -------------------------------------------------------------------------
+    def insert(self, index, value):
+        """
+        Insert *value* before *index*, as list.insert() does
+        """
+        if index < 0:
+            index = max(0, index + len(self))
+        try:
+            self._split(index, [value], 0)
+        except IndexError:
+            self.append(value)
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def load(cls, filepath, encoding=None, errors=None, binary=False):
+        """
+        Map the file at *filepath*. Lines will be decoded with *encoding*,
+        which defaults to what open() would use, and *errors*, or left as
+        bytes if *binary* is True.
+        """
+        rval = cls()
+        if not binary:
+            rval._encoding = encoding or locale.getpreferredencoding(False)
+            rval._errors = errors or 'strict'
+        with open(filepath, 'rb') as f:
+            if os.fstat(f.fileno()).st_size:
+                rval._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                rval._total = None
+                rval._pieces = [(0, None)]
+        return rval
+
+    # -------------------------------------------------------------------------
+    def reproduces(self, newline='\n'):
+        """
+        Return True if write() of the lines as they were mapped would give
+        back the mapped bytes, which is the case when every line in the
+        file ends with *newline*. Only '\\n' and '\\r\\n' are checked for.
+        Return None if there is no map to compare with.
+        """
+        if self._map is None:
+            return None
+        if isinstance(newline, bytes):
+            newline = newline.decode('latin-1')
+        if newline not in ('\n', '\r\n') or self._map[-1:] != b'\n':
+            return False
+        crlf = sum(_.count(b'\r\n') for _ in self._blocks(0, None))
+        return crlf == (self._count() if newline == '\r\n' else 0)
+
+    # -------------------------------------------------------------------------
+    def splice(self, idx, values=None):
+        """
+        Put *values* in place of the lines at the ascending positions *idx*,
+        or remove those lines if *values* is None, splitting the mapped
+        ranges around them in one pass over the pieces rather than one per
+        line
+        """
+        if values is None:
+            values = itertools.repeat(None)
+        edits = zip(idx, values)
+        where, value = next(edits, (None, None))
+        pieces = []
+        added = None
+        base = 0
+        for piece in self._pieces:
+            size = self._size(piece)
+            if where is None or where >= base + size:
+                pieces.append(piece)
+                base += size
+                continue
+            if isinstance(piece, list):
+                piece, drop = list(piece), set()
+                while where is not None and where < base + size:
+                    if value is None:
+                        drop.add(where - base)
+                    else:
+                        piece[where - base] = value
+                    where, value = next(edits, (None, None))
+                pieces.append([x for i, x in enumerate(piece)
+                               if i not in drop])
+                base += size
+                continue
+            line = piece[0]
+            while where is not None and where < base + size:
+                at = piece[0] + where - base
+                if line < at:
+                    pieces.append((line, at))
+                if value is None:
+                    pass
+                elif pieces and pieces[-1] is added:
+                    added.append(value)
+                else:
+                    added = [value]
+                    pieces.append(added)
+                line = at + 1
+                where, value = next(edits, (None, None))
+            if line < piece[0] + size:
+                pieces.append((line, piece[1]))
+            base += size
+        self._pieces = [_ for _ in pieces if _ != []] or [[]]
+
+    # -------------------------------------------------------------------------
+    def write(self, out, newline='\n'):
+        """
+        Write the lines to file *out*, each followed by *newline*. Where
+        that would reproduce the mapped bytes exactly, the untouched ranges
+        are copied from the map to out.buffer (or to *out* itself, for bytes
+        lines) without decoding.
+        """
+        if self._map is not None and self._encoding is None:
+            raw, dest = newline == b'\n', out
+        else:
+            raw = (newline == '\n' and self._map is not None and
+                   _codec(getattr(out, 'encoding', None)) ==
+                   _codec(self._encoding))
+            dest = getattr(out, 'buffer', None)
+        for piece in self._pieces:
+            if isinstance(piece, list):
+                out.writelines(x + newline for x in piece)
+                continue
+            if not raw:
+                out.writelines(x + newline for x in self._read(*piece))
+                continue
+            out.flush()
+            block = b''
+            for block in self._blocks(*piece):
+                if b'\r' in block:
+                    dest.write(block.replace(b'\r\n', b'\n'))
+                else:
+                    dest.write(block)
+            if block and not block.endswith(b'\n'):
+                dest.write(b'\n')
+        out.flush()
+
+    # -------------------------------------------------------------------------
+    def _blocks(self, start, stop):
+        """
+        Yield the bytes of lines *start* up to *stop* of the map in blocks of
+        about *blocksize* bytes, each ending at the end of a line (or of the
+        file)
+        """
+        pos = self._offset(start)
+        end = len(self._map) if stop is None else self._offset(stop)
+        while pos < end:
+            cut = min(pos + self.blocksize, end)
+            if cut < end:
+                found = self._map.rfind(b'\n', pos, cut)
+                cut = (self._map.find(b'\n', cut, end) + 1 if found < 0 else
+                       found + 1) or end
+            yield self._map[pos:cut]
+            pos = cut
+
+    # -------------------------------------------------------------------------
+    def _count(self):
+        """
+        Return the number of lines in the mapped file, counting newlines a
+        block at a time the first time through
+        """
+        if self._total is None:
+            size = len(self._map)
+            total = sum(self._map[_:_ + self.blocksize].count(b'\n')
+                        for _ in range(0, size, self.blocksize))
+            if self._map[size - 1:] != b'\n':
+                total += 1
+            self._total = total
+        return self._total
+
+    # -------------------------------------------------------------------------
+    def _decode(self, block):
+        """
+        Split the bytes *block* into decoded lines, or bytes lines if the map
+        was loaded in binary mode
+        """
+        if self._encoding is None:
+            text, nl, cr = block, b'\n', b'\r'
+        else:
+            text = block.decode(self._encoding, self._errors)
+            nl, cr = '\n', '\r'
+        lines = text.split(nl)
+        if text.endswith(nl):
+            lines.pop()
+        if cr in text:
+            lines = [_[:-1] if _.endswith(cr) else _ for _ in lines]
+        return lines
+
+    # -------------------------------------------------------------------------
+    def _index_to(self, line):
+        """
+        Extend the line index through *line*. Return False if the file has
+        no such line.
+        """
+        offsets = self._offsets
+        size = len(self._map)
+        while len(offsets) <= line + 1 and offsets[-1] < size:
+            found = self._map.find(b'\n', offsets[-1])
+            offsets.append(size if found < 0 else found + 1)
+        return line < len(offsets) - 1
+
+    # -------------------------------------------------------------------------
+    def _line(self, line):
+        """
+        Decode line number *line* of the mapped file
+        """
+        self._index_to(line)
+        return self._decode(self._map[self._offsets[line]:
+                                      self._offsets[line + 1]])[0]
+
+    # -------------------------------------------------------------------------
+    def _locate(self, index):
+        """
+        Return (piece number, offset in piece) for position *index*, which
+        must be in range
+        """
+        for pdx, piece in enumerate(self._pieces):
+            if isinstance(piece, tuple) and piece[1] is None:
+                if self._index_to(piece[0] + index):
+                    return pdx, index
+            elif index < self._size(piece):
+                return pdx, index
+            index -= self._size(piece)
+        raise IndexError("line index out of range")
+
+    # -------------------------------------------------------------------------
+    def _offset(self, line):
+        """
+        Return the byte offset in the map where *line* starts
+        """
+        if not self._index_to(line):
+            return len(self._map)
+        return self._offsets[line]
+
+    # -------------------------------------------------------------------------
+    def _position(self, index):
+        """
+        Turn a possibly negative *index* into a position, raising IndexError
+        if it is out of range. Only negative positions need the length.
+        """
+        if index < 0:
+            index += len(self)
+            if index < 0:
+                raise IndexError("line index out of range")
+        self._locate(index)
+        return index
+
+    # -------------------------------------------------------------------------
+    def _read(self, start, stop):
+        """
+        Yield the decoded lines *start* up to *stop* of the mapped file
+        """
+        for block in self._blocks(start, stop):
+            for line in self._decode(block):
+                yield line
+
+    # -------------------------------------------------------------------------
+    def _size(self, piece):
+        """
+        Return the number of lines in *piece*
+        """
+        if isinstance(piece, list):
+            return len(piece)
+        start, stop = piece
+        return (self._count() if stop is None else stop) - start
+
+    # -------------------------------------------------------------------------
+    def _split(self, index, lines, drop):
+        """
+        At position *index*, remove *drop* lines and put *lines* in their
+        place, splitting a mapped range around them if need be
+        """
+        pdx, off = self._locate(index)
+        piece = self._pieces[pdx]
+        if isinstance(piece, list):
+            piece[off:off + drop] = lines
+            return
+        start, stop = piece
+        parts = [(start, start + off)] if off else []
+        parts.append(lines)
+        if stop is None or start + off + drop < stop:
+            parts.append((start + off + drop, stop))
+        self._pieces[pdx:pdx + 1] = [_ for _ in parts if _ != []]
+        if not self._pieces:
+            self._pieces = [[]]
+
+
+# -----------------------------------------------------------------------------
+def _codec(encoding):
+    """
+    Return the canonical name of *encoding*, or None if it is unknown
+    """
+    try:
+        return codecs.lookup(encoding).name
+    except (LookupError, TypeError):
+        return None
+
+
+# -----------------------------------------------------------------------------
+def starts_with(lines, head):
+    """
+    Return True if the first len(*head*) entries of *lines* are *head*. Two
+    MappedLines buffers over the same map are compared piece by piece when
+    they can be, without decoding the mapped lines.
+    """
+    if len(lines) < len(head):
+        return False
+    if (isinstance(lines, MappedLines) and isinstance(head, MappedLines) and
+            head._map is not None and lines._map is head._map and
+            lines._pieces[:len(head._pieces)] == head._pieces):
+        return True
+    return all(map(operator.eq, head, lines))
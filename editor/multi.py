@@ -0,0 +1,84 @@
+"""
+Apply one edit script to many files at once
+"""
+import collections
+import glob
+import os
+
+import editor
+
+
+Result = collections.namedtuple('Result', ['path', 'changed', 'counts',
+                                           'backup', 'error'])
+Result.__doc__ = """
+The outcome of editing one file with edit_files(): whether its content
+changed, what each step of the script returned (lists, such as the lines
+removed by delete(), are given as their lengths), the backup file name if
+one was made, and the exception raised if the edit failed. In stream mode
+the edits are only applied as the file is written, so whether anything
+changed is not known and changed is None.
+"""
+
+
+# -----------------------------------------------------------------------------
+def edit_files(paths, script, workers=None, threads=False, save=True,
+               **kwargs):
+    """
+    Edit each file in *paths* with *script* and return a list of Result
+    tuples in the same order. *paths* may be a list of paths or a glob
+    pattern, which can use '**' to match directories recursively.
+
+    *script* is either a list of steps like ('sub', 'foo', 'bar') or
+    ('delete', '^#'), each naming an editor method and giving its
+    arguments, or a function that is called with the editor object and
+    whose return value becomes the counts of the Result. Other keyword
+    arguments, such as backup and storage, go to the editor constructor,
+    and *save* goes to quit().
+
+    The files are edited in a pool of *workers* processes, or threads if
+    *threads* is True, which suits I/O bound scripts on small files better.
+    *workers* defaults to the number of CPUs. With just one, the files are
+    edited one after another in this process. With processes, *script* and
+    the constructor arguments must be picklable, so a script function must
+    be defined at module level. An exception in one file's edit is
+    returned in its Result and does not stop the others.
+    """
+    if isinstance(paths, str):
+        paths = sorted(glob.glob(paths, recursive=True))
+    else:
+        paths = list(paths)
+    workers = workers or os.cpu_count() or 1
+    count = len(paths)
+    args = [paths, [script] * count, [save] * count, [kwargs] * count]
+    if workers == 1:
+        return list(map(_edit_one, *args))
+    import concurrent.futures
+    if threads:
+        pool = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+        chunksize = 1
+    else:
+        pool = concurrent.futures.ProcessPoolExecutor(max_workers=workers)
+        chunksize = max(1, len(paths) // (workers * 4))
+    with pool:
+        return list(pool.map(_edit_one, *args, chunksize=chunksize))
+
+
+# -----------------------------------------------------------------------------
+def _edit_one(path, script, save, kwargs):
+    """
+    Edit the file at *path* with *script* and return its Result
+    """
+    try:
+        q = editor.editor(path, **kwargs)
+        if callable(script):
+            counts = script(q)
+        else:
+            counts = []
+            for step in script:
+                rval = getattr(q, step[0])(*step[1:])
+                counts.append(len(rval) if isinstance(rval, list) else rval)
+        changed = None if q.stream else q.changed()
+        q.quit(save=save)
+        return Result(path, changed, counts, q.backup_filename(), None)
+    except Exception as err:
+        return Result(path, None, None, None, err)
@@ -0,0 +1,185 @@
+"""
+A content-addressed store for backups
+"""
+import hashlib
+import os
+import tempfile
+import zlib
+
+try:
+    from urllib.parse import quote
+except ImportError:
+    from urllib import quote
+
+
+# -----------------------------------------------------------------------------
+class BackupStore(object):
+    """
+    Backups kept in directory *path* as chunks of file content, each stored
+    once under its SHA-256 digest in path/objects, and a manifest per backup
+    in path/manifests listing the digests of its chunks in order.
+
+    Chunk boundaries are chosen by the content: a chunk ends after a line
+    whose CRC-32 has all the bits of *mask* clear (about one line in 1024),
+    or once it reaches *maxchunk* bytes. A change to a few lines of a file
+    therefore changes only the chunks around them, and a new backup of a
+    slowly changing file adds little more than its manifest.
+
+    Manifests are grouped by the absolute path of the file backed up, so
+    files with the same name in different directories don't collide.
+    """
+    mask = 0x3ff
+    maxchunk = 1 << 22
+
+    # -------------------------------------------------------------------------
+    def __init__(self, path):
+        """
+        Use (and create, if need be) the store in directory *path*
+        """
+        self.path = path
+        for sub in ['manifests', 'objects']:
+            if not os.path.isdir(os.path.join(path, sub)):
+                os.makedirs(os.path.join(path, sub))
+
+    # -------------------------------------------------------------------------
+    def collect(self):
+        """
+        Remove the chunks no manifest refers to, as removing manifests
+        leaves them behind. Return the number removed.
+        """
+        keep = set()
+        mroot = os.path.join(self.path, 'manifests')
+        for fdir in os.listdir(mroot):
+            for name in _listdir(os.path.join(mroot, fdir)):
+                keep.update(self._manifest(os.path.join(mroot, fdir, name)))
+        rval = 0
+        oroot = os.path.join(self.path, 'objects')
+        for prefix in os.listdir(oroot):
+            for rest in _listdir(os.path.join(oroot, prefix)):
+                if prefix + rest not in keep:
+                    os.unlink(os.path.join(oroot, prefix, rest))
+                    rval += 1
+        return rval
+
+    # -------------------------------------------------------------------------
+    def manifest_dir(self, filepath):
+        """
+        Return the directory holding the manifests of backups of *filepath*
+        """
+        return os.path.join(self.path, 'manifests',
+                            quote(os.path.abspath(filepath), safe=''))
+
+    # -------------------------------------------------------------------------
+    def remove(self, filepath, version):
+        """
+        Remove backup *version* of *filepath*. Its chunks stay in the store
+        until collect() is called.
+        """
+        os.unlink(os.path.join(self.manifest_dir(filepath), version))
+
+    # -------------------------------------------------------------------------
+    def restore(self, filepath, version, dest=None):
+        """
+        Rebuild backup *version* of *filepath* in *dest*, which defaults to
+        *filepath* itself. Return the path written.
+        """
+        dest = dest or filepath
+        mpath = os.path.join(self.manifest_dir(filepath), version)
+        with open(dest, 'wb') as out:
+            for digest in self._manifest(mpath):
+                with open(self._object(digest), 'rb') as f:
+                    out.write(f.read())
+        return dest
+
+    # -------------------------------------------------------------------------
+    def save(self, filepath, version):
+        """
+        Back up *filepath* as *version*, storing the chunks not already in
+        the store. Return the path of the manifest.
+        """
+        digests = []
+        with open(filepath, 'rb') as f:
+            for chunk in self._chunks(f):
+                digest = hashlib.sha256(chunk).hexdigest()
+                opath = self._object(digest)
+                if not os.path.exists(opath):
+                    self._write(opath, chunk)
+                digests.append(digest)
+        mdir = self.manifest_dir(filepath)
+        if not os.path.isdir(mdir):
+            os.makedirs(mdir)
+        mpath = os.path.join(mdir, version)
+        self._write(mpath, "".join(x + "\n" for x in digests).encode())
+        return mpath
+
+    # -------------------------------------------------------------------------
+    def versions(self, filepath):
+        """
+        Return the names of the backups of *filepath* in the store, sorted
+        """
+        mdir = self.manifest_dir(filepath)
+        if not os.path.isdir(mdir):
+            return []
+        return sorted(_listdir(mdir))
+
+    # -------------------------------------------------------------------------
+    def _chunks(self, f):
+        """
+        Yield the content of binary file *f* in chunks that end at line
+        boundaries picked by *mask*, or at *maxchunk* bytes
+        """
+        chunk = []
+        size = 0
+        for line in f:
+            chunk.append(line)
+            size += len(line)
+            if not zlib.crc32(line) & self.mask or size >= self.maxchunk:
+                yield b"".join(chunk)
+                chunk = []
+                size = 0
+        if chunk:
+            yield b"".join(chunk)
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def _manifest(mpath):
+        """
+        Return the list of chunk digests in manifest *mpath*
+        """
+        with open(mpath, 'r') as f:
+            return f.read().split()
+
+    # -------------------------------------------------------------------------
+    def _object(self, digest):
+        """
+        Return the path of the chunk with *digest*
+        """
+        return os.path.join(self.path, 'objects', digest[:2], digest[2:])
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def _write(path, data):
+        """
+        Write *data* to *path* by way of a temporary file, so a reader never
+        sees it partly written
+        """
+        tdir = os.path.dirname(path)
+        if not os.path.isdir(tdir):
+            os.makedirs(tdir)
+        fd, tmp = tempfile.mkstemp(dir=tdir, prefix=".tmp")
+        try:
+            with os.fdopen(fd, 'wb') as out:
+                out.write(data)
+            os.replace(tmp, path)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+
+
+# -----------------------------------------------------------------------------
+def _listdir(path):
+    """
+    Return the names in directory *path*, leaving out the temporary files
+    of writes in progress
+    """
+    return [x for x in os.listdir(path) if not x.startswith(".")]
@@ -1,27 +1,46 @@
 catalog = {
     'abm': "alt_backup_marker",
     'after': "This goes after the last line",
+    'bang': "!",
+    'bgnd': "background",
     'altfile': "another_filename",
     'before': "This goes before the first line",
+    'bigf': "bigfile",
+    'binl': [b"caf\xe9 au lait", b"\xff\xfe raw bytes", b"plain ascii"],
     'bkup': ".backup",
     'called': "called",
+    'chnk': "chunked",
     'closed': "This file is already closed",
+    'cmpr': {"bz2": ".bz2", "gzip": ".gz", "lzma": ".xz"},
+    'cmpt': "compact",
+    'cprg': "copyrange",
+    'cr': "\r",
     'crlf': "\r\n",
     'dfid': ".fiddle",
     'dfmt': ".%Y.%m%d.%H%M%S",
+    'dot': ".",
     'drgx': "\.\d{4}\.\d{4}\.\d{6}",
     'err': "Error",
     'flake_cmd': "flake8 conftest.py editor tests",
     'frib': "fribble",
     'froo': ".frooble",
     'frst': "First line",
+    'hlnk': "hardlink",
     'last': "Last line",
+    'lf': "\n",
     'load': "load",
+    'ltn1': "latin-1",
+    'keep': "keep",
     'lowa': "a",
     'lowe': "e",
+    'maxa': "maxage",
     'middle': "This goes in the middle",
     'miss': "No filepath specified",
+    'mmap': "mmap",
     'new': "This line is not in the original test data",
+    'nfmt': "{0:06d}",
+    'noap': "noappend",
+    'nosuch': "no such thing",
     'nwfl': "newfile",
     'one': "one",
     'oops': "Oops! I should not have added this line",
@@ -33,15 +52,33 @@ catalog = {
     'ovwr_l': ["This is the overwriting data",
                "Once the test is done, this",
                "should no longer be present."],
+    'rflk': "reflink",
+    'rnam': "rename",
     'save': "save",
+    'sesc': "surrogateescape",
+    'script': [("sub", "e", "E"),
+               ("append", "This line is not in the original test data"),
+               ("delete", " test"),
+               ("insert", "This goes before the first line"),
+               ("insert", "This goes in the middle", 2),
+               ("insert", "This goes before the last line", -1),
+               ("sub", "a", "A")],
+    'stor': "store",
+    'strm': "not available in stream mode",
     'stst': " test",
     'test': "test",
+    'that': "THAT",
+    'this': "this",
+    'tmid': "middle",
     'two': "two",
+    'vfmt': ".v{0}",
     'uppA': "A",
     'uppE': "E",
     'wump': ".wumpus",
+    'wend': "e$",
     'whsp': "     ",
     'with': "with_whitespace",
+    'xline': "the\\nover",
     'ymdf': ".%Y%b%d",
     'ymd_rgx': "^\.\d{4}\w{3}\d{2}$",
     }
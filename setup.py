@@ -11,8 +11,10 @@ config = {
     'author_email': 'tom.barron@comcast.net',
     'version': '0.1',
     'install_requires': [],
+    'python_requires': '>=3.6',
     'packages': ['editor'],
     'scripts': [],
+    'entry_points': {'console_scripts': ['pyedit = editor.__main__:main']},
     'name': 'editor'
 }
 
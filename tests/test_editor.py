@@ -1,10 +1,25 @@
+import asyncio
+import concurrent.futures
+import datetime as dt
 import editor
+import editor.aio
+import editor.multi
+import editor.store
+import functools
 import glob
+import importlib
+import io
+import os
 import pexpect
 import py
 import pytest
+import random
 import re
+import subprocess
+import sys
 import tbx
+import threading
+import tracemalloc
 
 from editor.text import catalog as K
 
@@ -74,6 +89,185 @@ def test_append(tmpdir, td, fx_chdir):
     assert exp == td.filename.read()
 
 
+# -----------------------------------------------------------------------------
+def test_batch():
+    """
+    Verify that calls queued in a batch() block give the same buffer as the
+    same calls made one at a time, and that delete() results are filled in
+    when the block exits
+    """
+    pytest.debug_func()
+    q = editor.editor(content=K["orig_l"][:])
+    b = editor.editor(content=K["orig_l"][:])
+    apply_script(q, K["script"])
+    with b.batch():
+        apply_script(b, K["script"])
+        rmd = b.delete(K["tmid"])
+        assert b.buffer == K["orig_l"]
+        assert rmd == []
+    assert rmd == [K["middle"]]
+    assert b.buffer == [_ for _ in q.buffer if _ != K["middle"]]
+
+
+# -----------------------------------------------------------------------------
+def test_batch_abort():
+    """
+    Verify that an exception inside a batch() block discards the queued calls
+    """
+    pytest.debug_func()
+    q = editor.editor(content=K["orig_l"][:])
+    with pytest.raises(ZeroDivisionError):
+        with q.batch():
+            q.sub(K["lowe"], K["uppE"])
+            1 / 0
+    assert q.buffer == K["orig_l"]
+    q.sub(K["lowe"], K["uppE"])
+    assert q.buffer != K["orig_l"]
+
+
+# -----------------------------------------------------------------------------
+def test_append_only(tmpdir, td, fx_chdir):
+    """
+    Verify that when lines were only added at the end, quit() appends them
+    to the original file rather than replacing it, and that 'noappend'
+    skips the backup in that case
+    """
+    pytest.debug_func()
+    inode = td.filename.stat().ino
+    q = editor.editor(td.basename, backup=K["noap"])
+    q.append(K["new"])
+    q.append(K["last"])
+    q.quit()
+    glob_assert("*", 1)
+    assert td.filename.stat().ino == inode
+    exp = written_format(K["orig_l"] + [K["new"], K["last"]])
+    assert exp == td.filename.read()
+
+
+# -----------------------------------------------------------------------------
+def test_append_only_changed(tmpdir, td, fx_chdir):
+    """
+    Verify that quit() writes the whole buffer when the file changed on
+    disk after it was loaded, lines besides the end were changed, or the
+    backup routine moved the file away
+    """
+    pytest.debug_func()
+    q = editor.editor(td.basename, backup=K["noap"])
+    q.append(K["new"])
+    td.filename.write(written_format(K["ovwr_l"]))
+    q.quit()
+    glob_assert("*", 2)
+    assert written_format(K["orig_l"] + [K["new"]]) == td.filename.read()
+
+    q = editor.editor(td.basename, backup=K["dfid"])
+    q.buffer[0] = K["frst"]
+    q.append(K["last"])
+    q.quit()
+    exp = written_format([K["frst"]] + K["orig_l"][1:] + [K["new"],
+                                                          K["last"]])
+    assert exp == td.filename.read()
+
+    def mover(ext):
+        os.rename(td.basename, td.basename + ext)
+
+    q = editor.editor(td.basename, backup=mover)
+    q.append(K["after"])
+    q.quit()
+    assert written_format(exp.splitlines() + [K["after"]]) == \
+        td.filename.read()
+
+
+# -----------------------------------------------------------------------------
+def test_async(tmpdir, td, fx_chdir):
+    """
+    Verify that AsyncEditor loads, edits, and saves many files concurrently
+    through a bounded executor
+    """
+    pytest.debug_func()
+    names = [K["nfmt"].format(_) for _ in range(8)]
+    for name in names:
+        tmpdir.join(name).write(written_format(K["orig_l"]))
+    pool = concurrent.futures.ThreadPoolExecutor(max_workers=2)
+
+    async def edit(name):
+        q = await editor.aio.AsyncEditor(name, executor=pool,
+                                         backup=K["bkup"]).load()
+        assert q.buffer == K["orig_l"]
+        assert q.sub(K["stst"], K["that"]) == 2
+        q.append(name)
+        q.buffer = q.buffer[1:]
+        return await q.quit()
+
+    async def main():
+        return await asyncio.gather(*[edit(_) for _ in names])
+
+    assert asyncio.run(main()) == [True] * len(names)
+    pool.shutdown()
+    exp = [_.replace(K["stst"], K["that"]) for _ in K["orig_l"][1:]]
+    for name in names:
+        assert asyncio.run(editor.aio.AsyncEditor.contents(name)) == \
+            exp + [name]
+    glob_assert("*", 1 + 2 * len(names))
+    with pytest.raises(editor.Error):
+        editor.aio.AsyncEditor(names[0]).sub(K["stst"], K["that"])
+
+
+# -----------------------------------------------------------------------------
+def test_atomic(tmpdir, td, fx_chdir, monkeypatch):
+    """
+    Verify that quit() saves through a temporary file that takes the
+    original's place and mode, that a failed write leaves the original
+    whole and no temporary file behind, that atomic=False writes into
+    the original, that a symbolic link is saved through, and that a new
+    file gets the mode the umask allows
+    """
+    pytest.debug_func()
+    td.filename.chmod(0o640)
+    inode = td.filename.stat().ino
+
+    def broken(out, lines, newline, size):
+        out.write(K["oops"])
+        raise OSError(K["oops"])
+
+    q = editor.editor(td.basename, backup=K["bkup"])
+    q.insert(K["new"])
+    with monkeypatch.context() as m:
+        m.setattr(editor, '_write_lines', broken)
+        with pytest.raises(OSError):
+            q.quit()
+    assert td.filename.read() == written_format(K["orig_l"])
+    assert sorted(os.listdir()) == [td.basename, td.basename + K["bkup"]]
+
+    q = editor.editor(td.basename, backup=K["bkup"])
+    q.insert(K["new"])
+    assert q.quit()
+    assert td.filename.read() == written_format([K["new"]] + K["orig_l"])
+    assert td.filename.stat().ino != inode
+    assert td.filename.stat().mode & 0o777 == 0o640
+
+    inode = td.filename.stat().ino
+    q = editor.editor(td.basename, backup=K["bkup"], atomic=False)
+    q.delete(K["new"])
+    assert q.quit()
+    assert td.filename.read() == written_format(K["orig_l"])
+    assert td.filename.stat().ino == inode
+
+    os.symlink(td.basename, K["altfile"])
+    q = editor.editor(K["altfile"], backup=K["bkup"])
+    q.insert(K["new"])
+    assert q.quit()
+    assert os.path.islink(K["altfile"])
+    assert td.filename.read() == written_format([K["new"]] + K["orig_l"])
+
+    umask = os.umask(0o022)
+    try:
+        q = editor.editor(K["nwfl"], content=K["orig_l"])
+        assert q.quit()
+    finally:
+        os.umask(umask)
+    assert os.stat(K["nwfl"]).st_mode & 0o777 == 0o644
+
+
 # -----------------------------------------------------------------------------
 def test_backup_altfunc(tmpdir, td, fx_chdir):
     """
@@ -82,6 +276,7 @@ def test_backup_altfunc(tmpdir, td, fx_chdir):
     """
     pytest.debug_func()
     q = editor.editor(td.basename, backup=alt_backup)
+    q.insert(K["new"])
     q.quit()
     fl = glob_assert("*", 2)
     assert K["abm"] + K["dfmt"] in fl
@@ -96,11 +291,144 @@ def test_backup_altfunc_q(tmpdir, td, fx_chdir):
     pytest.debug_func()
     q = editor.editor(td.basename)
     fl = glob_assert("*", 1)
+    q.insert(K["new"])
     q.quit(backup=alt_backup)
     fl = glob_assert("*", 2)
     assert K["abm"] + K["dfmt"] in fl
 
 
+# -----------------------------------------------------------------------------
+def test_backup_background(tmpdir, td, fx_chdir):
+    """
+    Verify that backup='background' lets the constructor return before the
+    load time backup is done, that quit() waits for it, and that an error
+    in the backup is raised by quit()
+    """
+    pytest.debug_func()
+    go = threading.Event()
+
+    def slow_backup(ext):
+        go.wait()
+        alt_backup(ext)
+
+    q = editor.editor(td.basename, backup=(K["bgnd"], K["load"], slow_backup))
+    glob_assert("*", 1)
+    q.buffer[0] = K["new"]
+    go.set()
+    q.quit()
+    fl = glob_assert("*", 2)
+    assert K["abm"] + K["dfmt"] in fl
+
+    def bad_backup(ext):
+        raise editor.Error(K["oops"])
+
+    q = editor.editor(td.basename, backup=(K["bgnd"], K["load"], bad_backup))
+    with pytest.raises(editor.Error) as err:
+        q.quit(save=False)
+    assert K["oops"] in str(err.value)
+
+
+# -----------------------------------------------------------------------------
+def test_backup_compress(tmpdir, td, fx_chdir):
+    """
+    Verify that {'compress': name} writes a compressed backup with the
+    matching suffix
+    """
+    pytest.debug_func()
+    for name, suffix in K["cmpr"].items():
+        q = editor.editor(td.basename, backup=({'compress': name}, K["bkup"]))
+        q.insert(K["new"])
+        q.quit()
+        bfile = td.basename + K["bkup"] + suffix
+        assert q.backup_filename() == bfile
+        with importlib.import_module(name).open(bfile, 'rt') as f:
+            assert f.read() == td.filename.read().split("\n", 1)[1]
+        td.filename.write(written_format(K["orig_l"]))
+    with pytest.raises(editor.Error):
+        editor.editor(td.basename, backup={'compress': K["nosuch"]})
+    with pytest.raises(editor.Error):
+        editor.editor(td.basename, backup={K["nosuch"]: 1})
+
+
+# -----------------------------------------------------------------------------
+def test_backup_retention(tmpdir, td, fx_chdir):
+    """
+    Verify that {'keep': N} and {'maxage': secs} remove old backups, but not
+    the one just made or files that are not backups
+    """
+    pytest.debug_func()
+
+    def old_backups():
+        for day in range(1, 5):
+            stamp = dt.datetime(2020, 1, day).strftime(K["dfmt"])
+            tmpdir.join(td.basename + stamp).write(K["one"])
+            if day == 1:
+                stamp += K["cmpr"]["gzip"]
+                tmpdir.join(td.basename + stamp).write(K["one"])
+
+    old_backups()
+    tmpdir.join(td.basename + K["bkup"]).write(K["one"])
+    glob_assert("*", 7)
+    q = editor.editor(td.basename, backup={K["keep"]: 2})
+    q.insert(K["new"])
+    q.quit()
+    fl = glob_assert("*", 4)
+    assert td.basename + K["bkup"] in fl
+    assert q.backup_filename() in fl
+    assert td.basename + dt.datetime(2020, 1, 4).strftime(K["dfmt"]) in fl
+    os.unlink(q.backup_filename())
+
+    old_backups()
+    q = editor.editor(td.basename, backup={K["maxa"]: 3600})
+    q.insert(K["new"])
+    q.quit()
+    fl = glob_assert("*", 3)
+    assert q.backup_filename() in fl
+    os.unlink(q.backup_filename())
+
+    old_backups()
+    q = editor.editor(td.basename, backup=(K["load"],
+                                           {K["maxa"]: dt.timedelta(1)}))
+    glob_assert("*", 3)
+    q.quit(save=False)
+
+
+# -----------------------------------------------------------------------------
+def test_backup_store(tmpdir, td, fx_chdir, monkeypatch):
+    """
+    Verify that {'store': path} keeps backups in a BackupStore, which
+    stores unchanged chunks only once and can restore every version
+    """
+    pytest.debug_func()
+    monkeypatch.setattr(editor.store.BackupStore, 'mask', 0x7)
+    sdir = tmpdir.join(K["stor"]).strpath
+    data = [K["nfmt"].format(_) for _ in range(500)]
+    td.filename.write(written_format(data))
+    versions = [list(data)]
+    for num in range(1, 4):
+        q = editor.editor(td.basename,
+                          backup=({K["stor"]: sdir}, K["vfmt"].format(num)))
+        q.buffer[num * 100] = K["new"]
+        q.quit()
+        versions.append(list(q.buffer))
+        assert q.backup_filename().startswith(sdir)
+    glob_assert("*", 2)
+    store = editor.store.BackupStore(sdir)
+    names = [td.basename + K["vfmt"].format(_) for _ in range(1, 4)]
+    assert store.versions(td.basename) == names
+    objects = tmpdir.join(K["stor"], "objects").visit(lambda x: x.isfile())
+    assert len(list(objects)) < 500 / 8 * 1.5
+    alt = tmpdir.join(K["altfile"]).strpath
+    for name, lines in zip(names, versions):
+        assert editor.editor.contents(store.restore(td.basename, name,
+                                                    alt)) == lines
+    store.remove(td.basename, names[0])
+    assert store.collect() > 0
+    assert store.versions(td.basename) == names[1:]
+    store.restore(td.basename, names[1])
+    assert editor.editor.contents(td.basename) == versions[1]
+
+
 # -----------------------------------------------------------------------------
 def test_backup_default(tmpdir, td, fx_chdir):
     """
@@ -110,6 +438,7 @@ def test_backup_default(tmpdir, td, fx_chdir):
     pytest.debug_func()
     q = editor.editor(td.basename)
     fl = glob_assert("*", 1)
+    q.insert(K["new"])
     q.quit()
     fl = glob_assert("*", 2)
     assert td.basename in fl
@@ -140,6 +469,7 @@ def test_backup_default_strftime_q(tmpdir, td, fx_chdir):
     pytest.debug_func()
     q = editor.editor(td.basename, backup=(K["dfmt"], K["save"]))
     fl = glob_assert("*", 1)
+    q.insert(K["new"])
     q.quit()
     fl = glob_assert("*", 2)
     [other] = [x for x in fl if x != td.basename]
@@ -156,6 +486,7 @@ def test_backup_extension(tmpdir, td, fx_chdir):
     pytest.debug_func()
     q = editor.editor(td.basename, backup=K["dfid"])
     fl = glob_assert("*", 1)
+    q.insert(K["new"])
     q.quit()
     fl = glob_assert("*", 2)
     assert td.basename in fl
@@ -175,6 +506,7 @@ def test_backup_extension_q(tmpdir, td, fx_chdir):
     ext = '.fiddle'
     q = editor.editor(td.basename)
     fl = glob_assert("*", 1)
+    q.insert(K["new"])
     q.quit(backup=ext)
     fl = glob_assert("*", 2)
     assert td.basename in fl
@@ -192,6 +524,7 @@ def test_backup_func_ext(tmpdir, td, fx_chdir):
     pytest.debug_func()
     q = editor.editor(td.basename, backup=(K["wump"], alt_backup))
     fl = glob_assert("*", 1)
+    q.insert(K["new"])
     q.quit()
     fl = glob_assert("*", 2)
     assert K["abm"] + K["wump"] in fl
@@ -206,6 +539,7 @@ def test_backup_func_ymd(tmpdir, td, fx_chdir):
     pytest.debug_func()
     q = editor.editor(td.basename, backup=(alt_backup, K["ymdf"]))
     fl = glob_assert("*", 1)
+    q.insert(K["new"])
     q.quit()
     fl = glob_assert("*", 2)
     assert K["abm"] + K["ymdf"] in fl
@@ -234,6 +568,7 @@ def test_backup_func_ymd_save(tmpdir, td, fx_chdir):
     pytest.debug_func()
     q = editor.editor(td.basename, backup=(alt_backup, K["ymdf"], K["save"]))
     fl = glob_assert("*", 1)
+    q.insert(K["new"])
     q.quit()
     fl = glob_assert("*", 2)
     assert K["abm"] + K["ymdf"] in fl
@@ -283,6 +618,61 @@ def test_backup_load_func(tmpdir, td, fx_chdir):
     fl = glob_assert("*", 2)
 
 
+# -----------------------------------------------------------------------------
+def test_backup_methods(tmpdir, td, fx_chdir):
+    """
+    Verify that each backup method leaves the original content in the
+    backup file and the new content, with the old permissions, in the file,
+    and that 'rename' leaves the original in place when saving elsewhere
+    """
+    pytest.debug_func()
+    for method in [K["cprg"], K["hlnk"], K["rflk"], K["rnam"]]:
+        td.filename.write(written_format(K["orig_l"]))
+        td.filename.chmod(0o640)
+        inode = td.filename.stat().ino
+        q = editor.editor(td.basename, backup=(method, K["bkup"]))
+        q.append(K["new"])
+        assert q.quit()
+        bfile = tmpdir.join(td.basename + K["bkup"])
+        assert bfile.read() == written_format(K["orig_l"])
+        assert td.filename.read() == written_format(K["orig_l"] + [K["new"]])
+        assert td.filename.stat().mode & 0o777 == 0o640
+        if method in [K["hlnk"], K["rnam"]]:
+            assert bfile.stat().ino == inode
+            assert td.filename.stat().ino != inode
+        glob_assert("*", 2)
+
+    other = tmpdir.join(K["altfile"])
+    other.write(written_format(K["ovwr_l"]))
+    q = editor.editor(td.basename, backup=(K["rnam"], K["bkup"]))
+    assert q.quit(filepath=other.basename)
+    assert td.filename.read() == written_format(K["orig_l"] + [K["new"]])
+    assert other.read() == td.filename.read()
+
+
+# -----------------------------------------------------------------------------
+def test_backup_methods_load(tmpdir, td, fx_chdir):
+    """
+    Verify that backup methods 'rename' and 'hardlink' at load time leave
+    the original file in place, and that saving then does not change the
+    backup
+    """
+    pytest.debug_func()
+    for method in [K["hlnk"], K["rnam"]]:
+        td.filename.write(written_format(K["orig_l"]))
+        q = editor.editor(td.basename, backup=(method, K["load"], K["bkup"]))
+        assert td.filename.read() == written_format(K["orig_l"])
+        q.buffer[0] = K["new"]
+        q.quit()
+        bfile = tmpdir.join(td.basename + K["bkup"])
+        assert bfile.read() == written_format(K["orig_l"])
+        assert td.filename.read() == written_format([K["new"]] +
+                                                    K["orig_l"][1:])
+    q = editor.editor(td.basename, backup=(K["rnam"], K["load"], K["bkup"]))
+    q.quit(save=False)
+    assert td.filename.read() == written_format([K["new"]] + K["orig_l"][1:])
+
+
 # -----------------------------------------------------------------------------
 def test_backup_save(tmpdir, td, fx_chdir):
     """
@@ -291,6 +681,7 @@ def test_backup_save(tmpdir, td, fx_chdir):
     pytest.debug_func()
     q = editor.editor(td.basename, backup=K["save"])
     fl = glob_assert("*", 1)
+    q.insert(K["new"])
     q.quit()
     fl = glob_assert("*", 2)
     assert td.basename in fl
@@ -310,6 +701,7 @@ def test_backup_save_ext(tmpdir, td, fx_chdir):
     q = editor.editor(td.basename, backup=(K["save"], ext))
     fl = glob_assert("*", 1)
     assert td.basename in fl
+    q.insert(K["new"])
     q.quit()
     fl = glob_assert("*", 2)
     assert td.basename + ext in fl
@@ -323,6 +715,7 @@ def test_backup_save_func(tmpdir, td, fx_chdir):
     pytest.debug_func()
     q = editor.editor(td.basename, backup=(K["save"], alt_backup))
     fl = glob_assert("*", 1)
+    q.insert(K["new"])
     q.quit()
     fl = glob_assert("*", 2)
     assert K["abm"] + K["dfmt"] in fl
@@ -337,6 +730,7 @@ def test_backup_save_func_q(tmpdir, td, fx_chdir):
     pytest.debug_func()
     q = editor.editor(td.basename)
     fl = glob_assert("*", 1)
+    q.insert(K["new"])
     q.quit(backup=(K["save"], alt_backup))
     fl = glob_assert("*", 2)
     assert K["abm"] + K["dfmt"] in fl
@@ -352,10 +746,154 @@ def test_backup_function(tmpdir, td, backup_reset):
     assert not hasattr(squawker, K['called'])
     q = editor.editor(td.filename.strpath, backup=squawker)
     assert not hasattr(squawker, K['called'])
+    q.insert(K["new"])
     q.quit()
     assert hasattr(squawker, K['called']) and squawker.called
 
 
+# -----------------------------------------------------------------------------
+def test_binary(tmpdir, td):
+    """
+    Verify that binary=True gives bytes lines that need not be valid text,
+    in every storage, that sub(), sub_many(), and delete() take bytes
+    patterns, and that the file is saved byte for byte
+    """
+    pytest.debug_func()
+    data = written_format(K["binl"], b"\n")
+    exp = written_format([b"cafe AU milk", b"ascii plain"], b"\r\n")
+    for storage in ['list', K["chnk"], K["cmpt"], K["mmap"]]:
+        td.filename.write_binary(data)
+        q = editor.editor(td.filename.strpath, binary=True, storage=storage)
+        assert list(q.buffer) == K["binl"]
+        assert q.quit() is False
+        q = editor.editor(td.filename.strpath, binary=True, storage=storage)
+        assert q.sub(b"\xe9", b"e") == 1
+        assert q.sub(rb"^(\w+) (\w+)$", rb"\2 \1") == 1
+        assert q.delete(b"^\xff") == [K["binl"][1]]
+        assert q.sub_many([(b"au", b"AU"),
+                           (re.compile(b"LAIT", re.I), b"milk")]) == 1
+        q.quit(newline=b"\r\n")
+        assert td.filename.read_binary() == exp
+
+    q = editor.editor(td.filename.strpath, binary=True)
+    assert q.sub(b"a", b"4", joined=True) == 2
+    q.append(b"\x80")
+    q.quit()
+    assert td.filename.read_binary() == \
+        exp.replace(b"a", b"4") + b"\x80\r\n"
+    q = editor.editor(td.filename.strpath, binary=True)
+    q.append(K["binl"][1])
+    q.quit(backup=K["noap"])
+    assert td.filename.read_binary().endswith(b"\x80\r\n" + K["binl"][1] +
+                                              b"\r\n")
+    assert editor.editor.contents(td.filename.strpath, binary=True)[-1] == \
+        K["binl"][1]
+
+
+# -----------------------------------------------------------------------------
+def test_binary_stream(tmpdir, td, monkeypatch):
+    """
+    Verify that stream mode, with and without workers, and the command line
+    work on bytes in binary mode
+    """
+    pytest.debug_func()
+    monkeypatch.setattr(editor.editor, 'chunk_bytes', 100)
+    from editor.__main__ import main
+    data = K["binl"] * 50
+    exp = written_format([x.replace(b"raw", b"RAW") for x in data], b"\n")
+    for workers in [None, 2]:
+        td.filename.write_binary(written_format(data, b"\n"))
+        q = editor.editor(td.filename.strpath, binary=True, stream=True)
+        q.sub(b"raw", b"RAW", workers=workers)
+        q.quit()
+        assert td.filename.read_binary() == exp
+    td.filename.write_binary(written_format(data, b"\n"))
+    assert main(["--binary", "-s", "raw", "RAW", td.filename.strpath]) == 0
+    assert td.filename.read_binary() == exp
+
+
+# -----------------------------------------------------------------------------
+def test_chunked_lines():
+    """
+    Verify that ChunkedLines gives the same results as a list through a long
+    random series of inserts, deletes, appends, and assignments, with chunks
+    small enough that they split and empty often
+    """
+    pytest.debug_func()
+
+    class Small(editor.lines.ChunkedLines):
+        chunksize = 4
+
+    rand = random.Random(17)
+    ref = [str(_) for _ in range(30)]
+    cl = Small(ref)
+    for _ in range(2000):
+        pick = rand.random()
+        idx = rand.randint(-len(ref) - 2, len(ref) + 2)
+        if pick < 0.4:
+            ref.insert(idx, str(pick))
+            cl.insert(idx, str(pick))
+        elif pick < 0.7 and -len(ref) <= idx < len(ref):
+            del ref[idx]
+            del cl[idx]
+        elif pick < 0.8:
+            ref.append(str(pick))
+            cl.append(str(pick))
+        elif -len(ref) <= idx < len(ref):
+            ref[idx] = str(pick)
+            cl[idx] = str(pick)
+        assert len(cl) == len(ref)
+        assert cl[idx:idx + 3] == ref[idx:idx + 3]
+    assert cl == ref
+    assert list(cl) == [cl[_] for _ in range(len(cl))]
+
+
+# -----------------------------------------------------------------------------
+def test_compact(tmpdir, td, monkeypatch):
+    """
+    Verify that storage='compact' gives the same buffer and file as the
+    default list for the usual edits, with blocks small enough that some
+    lines are packed and some are not
+    """
+    pytest.debug_func()
+    monkeypatch.setattr(editor.lines.CompactLines, "blocksize", 2)
+    q = editor.editor(td.filename.strpath, storage=K["cmpt"])
+    assert isinstance(q.buffer, editor.lines.CompactLines)
+    r = editor.editor(content=K["orig_l"][:])
+    for ed in [q, r]:
+        apply_script(ed, K["script"])
+        ed.buffer[2] = K["new"]
+    assert q.buffer == r.buffer
+    q.quit(newline=K["crlf"])
+    exp = bytearray(written_format(r.buffer, newline=K["crlf"]), 'utf8')
+    assert exp == td.filename.read_binary()
+
+
+# -----------------------------------------------------------------------------
+def test_compact_memory():
+    """
+    Verify with tracemalloc that CompactLines holds many short lines in a
+    fraction of the memory a list of strings takes
+    """
+    pytest.debug_func()
+
+    count = 2 * editor.lines.CompactLines.blocksize
+
+    def numbers():
+        return (K["nfmt"].format(_) for _ in range(count))
+
+    tracemalloc.start()
+    listed = list(numbers())
+    list_size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    tracemalloc.start()
+    packed = editor.lines.CompactLines(numbers())
+    packed_size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    assert packed == listed
+    assert packed_size * 3 < list_size
+
+
 # -----------------------------------------------------------------------------
 def test_contents(tmpdir, fx_chdir):
     """
@@ -371,6 +909,60 @@ def test_contents(tmpdir, fx_chdir):
     assert result == K["ovwr_l"]
 
 
+# -----------------------------------------------------------------------------
+def test_cli(tmpdir, td, fx_chdir, monkeypatch, capsys):
+    """
+    Verify that python -m editor applies the edits in command line order,
+    to standard input or to files in place with backups
+    """
+    pytest.debug_func()
+    from editor.__main__ import main
+    edits = ["-s", K["stst"], K["that"], "-d", K["wend"], "-a", K["last"],
+             "-i", "0", K["frst"]]
+    monkeypatch.setattr(sys, 'stdin', io.StringIO(written_format(
+        K["orig_l"], K["crlf"])))
+    assert main(edits) == 0
+    exp = [K["frst"]] + [x.replace(K["stst"], K["that"])
+                         for x in K["orig_l"] if not x.endswith(K["lowe"])]
+    exp.append(K["last"])
+    assert capsys.readouterr().out == written_format(exp)
+
+    other = tmpdir.join(K["altfile"])
+    other.write(written_format(K["orig_l"]))
+    assert main(edits + ["-b", K["bkup"], "-j", "2", "-v", td.basename,
+                         other.basename]) == 0
+    assert td.filename.read() == other.read() == written_format(exp)
+    assert len(capsys.readouterr().err.splitlines()) == 2
+    glob_assert("*", 4)
+    assert main(["-d", "(", td.basename]) == 1
+    assert td.basename in capsys.readouterr().err
+    with pytest.raises(SystemExit):
+        main([td.basename])
+
+
+# -----------------------------------------------------------------------------
+def test_cli_startup(tmpdir):
+    """
+    Verify that python -m editor leaves out the modules that only some
+    features need, to keep startup quick
+    """
+    pytest.debug_func()
+    root = os.path.dirname(os.path.dirname(os.path.abspath(editor.__file__)))
+    env = dict(os.environ, PYTHONPATH=root)
+    result = subprocess.run([sys.executable, "-X", "importtime", "-m",
+                             "editor", "-s", K["stst"], K["that"]],
+                            input=K["orig_l"][0].encode(), env=env,
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                            cwd=tmpdir.strpath)
+    assert result.stdout.decode() == written_format(
+        [K["orig_l"][0].replace(K["stst"], K["that"])])
+    loaded = [x.split("|")[-1].strip()
+              for x in result.stderr.decode().splitlines()]
+    for name in ["concurrent.futures", "editor.multi", "editor.store",
+                 "hashlib", "subprocess"]:
+        assert name not in loaded
+
+
 # -----------------------------------------------------------------------------
 def test_closed(td):
     """
@@ -406,6 +998,22 @@ def test_delete(td):
     assert K["orig_l"][3] not in td.filename.read()
 
 
+# -----------------------------------------------------------------------------
+def test_delete_compiled(td):
+    """
+    Verifies that delete() and sub() accept compiled patterns as well as
+    strings
+    """
+    pytest.debug_func()
+    q = editor.editor(filepath=td.filename.strpath)
+    rmd = q.delete(re.compile(K["stst"]))
+    assert rmd == [K["orig_l"][1], K["orig_l"][3]]
+    assert q.buffer == [K["orig_l"][0], K["orig_l"][2]]
+    q.sub(re.compile(K["lowe"]), K["uppE"])
+    assert q.buffer == [_.replace(K["lowe"], K["uppE"])
+                        for _ in [K["orig_l"][0], K["orig_l"][2]]]
+
+
 # -----------------------------------------------------------------------------
 def test_dos(tmpdir, td):
     """
@@ -431,6 +1039,82 @@ def test_dos(tmpdir, td):
     assert exp == actual
 
 
+# -----------------------------------------------------------------------------
+def test_edit_files(tmpdir, fx_chdir):
+    """
+    Verify that edit_files() applies a script to every file matched in a
+    pool of processes or threads and reports on each one, with changed
+    None in stream mode, where it is not known
+    """
+    pytest.debug_func()
+    for num in range(6):
+        lines = K["orig_l"] if num % 2 else K["ovwr_l"]
+        tmpdir.join(K["nfmt"].format(num)).write(written_format(lines))
+    script = [("sub", K["wend"], K["that"]), ("delete", K["that"])]
+    for threads in [False, True]:
+        rval = editor.multi.edit_files(K["nfmt"].format(0)[:-1] + "?",
+                                       script, workers=2, threads=threads,
+                                       backup=K["bkup"])
+        paths = [K["nfmt"].format(_) for _ in range(6)]
+        assert [x.path for x in rval] == paths
+        for num, res in enumerate(rval):
+            assert res.error is None
+            if num % 2 and not threads:
+                assert res.changed and res.counts == [1, 1]
+                assert res.backup == res.path + K["bkup"]
+            else:
+                assert not res.changed and res.counts == [0, 0]
+                assert res.backup is None
+    glob_assert("*", 9)
+
+    def bad_script(q):
+        raise editor.Error(K["oops"])
+
+    rval = editor.multi.edit_files([K["nfmt"].format(1)], bad_script,
+                                   threads=True)
+    assert isinstance(rval[0].error, editor.Error)
+    rval = editor.multi.edit_files([K["nfmt"].format(1)],
+                                   [("sub", K["nosuch"] + "(", K["new"])])
+    assert isinstance(rval[0].error, re.error)
+    rval = editor.multi.edit_files([K["nfmt"].format(1)], script,
+                                   stream=True, save=False)
+    assert rval[0].error is None and rval[0].changed is None
+
+
+# -----------------------------------------------------------------------------
+def test_encoding(tmpdir, td, fx_chdir, monkeypatch):
+    """
+    Verify that *encoding* and *errors* are used to read and write the
+    file, including when quit() appends or rewrites the file in place
+    """
+    pytest.debug_func()
+    monkeypatch.setattr(editor.editor, 'inplace_min', 10)
+    text = [x.decode(K["ltn1"]) for x in K["binl"]]
+    td.filename.write_binary(written_format(K["binl"], b"\n"))
+    with pytest.raises(UnicodeDecodeError):
+        editor.editor(td.filename.strpath, encoding="utf-8")
+    assert editor.editor.contents(td.basename, K["ltn1"]) == text
+    q = editor.editor(td.filename.strpath, encoding=K["ltn1"])
+    assert q.buffer == text
+    q.append(text[0])
+    q.quit()
+    assert td.filename.read_binary() == \
+        written_format(K["binl"] + K["binl"][:1], b"\n")
+    q = editor.editor(td.filename.strpath, encoding=K["ltn1"])
+    q.buffer[-1] = text[2]
+    q.quit()
+    assert td.filename.read_binary() == \
+        written_format(K["binl"] + K["binl"][2:], b"\n")
+
+    td.filename.write_binary(written_format(K["binl"], b"\n"))
+    q = editor.editor(td.filename.strpath, encoding="utf-8",
+                      errors=K["sesc"], storage=K["mmap"])
+    q.sub("ascii", "ASCII")
+    q.quit()
+    assert td.filename.read_binary() == \
+        written_format(K["binl"], b"\n").replace(b"ascii", b"ASCII")
+
+
 # -----------------------------------------------------------------------------
 def test_init_content():
     """
@@ -445,6 +1129,73 @@ def test_init_content():
     assert b.buffer == K["orig_l"]
 
 
+# -----------------------------------------------------------------------------
+def test_inplace(tmpdir, td, fx_chdir, monkeypatch):
+    """
+    Verify that quit() with atomic=False rewrites only the lines from the
+    first one changed on when the unchanged start of the file is big
+    enough, and rewrites the whole file otherwise
+    """
+    pytest.debug_func()
+    monkeypatch.setattr(editor.editor, 'inplace_min', 1)
+
+    def tamper():
+        # change the first byte on disk without editor.quit() noticing
+        stat = td.filename.stat()
+        data = td.filename.read_binary()
+        td.filename.write_binary(data.swapcase()[:1] + data[1:])
+        os.utime(td.filename.strpath, ns=(stat.atime_ns, stat.mtime_ns))
+
+    inode = td.filename.stat().ino
+    q = editor.editor(td.basename, backup=K["bkup"], atomic=False)
+    q.buffer[-1] = K["last"]
+    q.append(K["new"])
+    tamper()
+    assert q.quit()
+    assert td.filename.stat().ino == inode
+    exp = K["orig_l"][:-1] + [K["last"], K["new"]]
+    assert td.filename.read() == written_format(exp).swapcase()[:1] + \
+        written_format(exp)[1:]
+    assert editor.editor.contents(td.basename + K["bkup"])[1:] == \
+        K["orig_l"][1:]
+
+    td.filename.write(written_format(K["orig_l"]))
+    q = editor.editor(td.basename, backup=K["bkup"], atomic=False)
+    q.delete(K["wend"])
+    assert q.quit()
+    assert td.filename.read() == written_format(
+        [x for x in K["orig_l"] if not x.endswith(K["lowe"])])
+
+    monkeypatch.setattr(editor.editor, 'inplace_min', 1 << 16)
+    q = editor.editor(td.basename, backup=K["bkup"], atomic=False)
+    q.append(K["new"])
+    q.buffer[-2] = K["last"]
+    tamper()
+    assert q.quit()
+    assert td.filename.read()[1:] == written_format(q.buffer)[1:]
+    assert td.filename.read()[:1] == q.buffer[0][:1]
+
+
+# -----------------------------------------------------------------------------
+def test_inplace_newlines(tmpdir):
+    """
+    Verify that quit() with atomic=False writes the whole file when the
+    file's lines did not all end with the terminator being written, so the
+    unchanged start of the buffer does not give the byte offset on disk
+    """
+    pytest.debug_func()
+    path = tmpdir.join(K["nwfl"])
+    head = [K["one"]] * 40000
+    for tail in [K["this"] + K["crlf"] + K["two"],
+                 K["this"] + K["lf"] + K["two"]]:
+        path.write_binary((written_format(head) + tail).encode())
+        q = editor.editor(path.strpath, atomic=False)
+        q.buffer[-1] = K["last"]
+        assert q.quit()
+        assert path.read_binary() == \
+            written_format(head + [K["this"], K["last"]]).encode()
+
+
 # -----------------------------------------------------------------------------
 def test_insert(tmpdir, td):
     """
@@ -469,6 +1220,162 @@ def test_insert(tmpdir, td):
     assert written_format(edited) == td.filename.read()
 
 
+# -----------------------------------------------------------------------------
+def test_insert_chunked(tmpdir, td):
+    """
+    Verify that storage='chunked' supports the same buffer operations as
+    the default list and writes the same file
+    """
+    pytest.debug_func()
+    q = editor.editor(td.filename.strpath, storage=K["chnk"])
+    assert isinstance(q.buffer, editor.lines.ChunkedLines)
+    edited = K["orig_l"][:]
+    for where in [0, len(q), 3, -1]:
+        q.insert(K["middle"], where)
+        edited.insert(where, K["middle"])
+        assert q.buffer == edited
+    r = editor.editor(content=edited)
+    for ed in [q, r]:
+        apply_script(ed, K["script"])
+    assert q.buffer == r.buffer
+    assert isinstance(q.buffer, editor.lines.ChunkedLines)
+    q.quit()
+    assert written_format(r.buffer) == td.filename.read()
+    with pytest.raises(editor.Error):
+        editor.editor(storage=K["nosuch"])
+
+
+# -----------------------------------------------------------------------------
+def test_mmap(tmpdir, td):
+    """
+    Verify that storage='mmap' reads lines on demand, copes with changes at
+    the top and bottom of the file, and saves the same content a list
+    buffer would
+    """
+    pytest.debug_func()
+    q = editor.editor(td.filename.strpath, storage=K["mmap"])
+    assert isinstance(q.buffer, editor.lines.MappedLines)
+    assert q.buffer[1] == K["orig_l"][1]
+    q.buffer[0] = K["frst"]
+    q.insert(K["before"])
+    q.append(K["last"])
+    del q.buffer[-2]
+    exp = [K["before"], K["frst"]] + K["orig_l"][1:-1] + [K["last"]]
+    assert q.buffer == exp
+    q.quit()
+    assert written_format(exp) == td.filename.read()
+    backup = py.path.local(q.backup_filename())
+    assert written_format(K["orig_l"]) == backup.read()
+
+
+# -----------------------------------------------------------------------------
+def test_mmap_crlf(tmpdir, td):
+    """
+    Verify that storage='mmap' strips CR-LF line endings like the default
+    load does, that sub() works on a mapped buffer, and that an unchanged
+    buffer, mapped or not, is still converted to a new line terminator
+    """
+    pytest.debug_func()
+    td.filename.write_binary(written_format(K["orig_l"],
+                                            newline=K["crlf"]).encode())
+    q = editor.editor(td.filename.strpath, storage=K["mmap"])
+    assert q.buffer == K["orig_l"]
+    q.sub(K["lowe"], K["uppE"])
+    q.quit()
+    exp = written_format([_.replace(K["lowe"], K["uppE"])
+                          for _ in K["orig_l"]])
+    assert exp == td.filename.read()
+
+    crlf = written_format(K["orig_l"], newline=K["crlf"]).encode()
+    for direct in [False, True]:
+        td.filename.write(written_format(K["orig_l"]))
+        q = editor.editor(td.filename.strpath, storage=K["mmap"],
+                          backup=K["bkup"])
+        assert q.sub(K["nosuch"], K["one"]) == 0
+        assert q.delete(K["nosuch"]) == []
+        assert q.buffer._map is not None
+        if direct:
+            q.buffer = editor.lines.MappedLines(list(q.buffer))
+        assert q.quit(newline=K["crlf"])
+        assert td.filename.read_binary() == crlf
+
+
+# -----------------------------------------------------------------------------
+def test_mmap_sparse(tmpdir, td):
+    """
+    Verify that sub() and delete() touching a few lines of a mapped buffer
+    change it in place, so it keeps its map, and that quit() saves what a
+    list buffer would
+    """
+    pytest.debug_func()
+    lines = [K["nfmt"].format(_) for _ in range(30)]
+    td.filename.write(written_format(lines))
+    q = editor.editor(td.filename.strpath, storage=K["mmap"])
+    mapped = q.buffer
+    assert q.sub("^000001$", K["one"]) == 1
+    assert q.sub("^00002[89]$", K["two"]) == 2
+    assert q.delete("^00001[0-4]$") == lines[10:15]
+    assert q.delete("^000000$") == lines[:1]
+    assert q.buffer is mapped and mapped._map is not None
+    exp = [K["one"]] + lines[2:10] + lines[15:28] + [K["two"]] * 2
+    assert q.buffer == exp
+    q.quit()
+    assert td.filename.read() == written_format(exp)
+
+
+# -----------------------------------------------------------------------------
+def test_newlines(tmpdir, td, fx_chdir, monkeypatch):
+    """
+    Verify that loading splits lines across read boundaries, records the
+    file's line terminators in newlines, and keeps them when the file is
+    saved
+    """
+    pytest.debug_func()
+    monkeypatch.setattr(editor.editor, 'read_size', 3)
+    for nl in [K["lf"], K["crlf"], K["cr"]]:
+        td.filename.write_binary(written_format(K["orig_l"], nl).encode())
+        for storage in ['list', K["chnk"], K["cmpt"]]:
+            q = editor.editor(td.basename, storage=storage)
+            assert q.buffer == K["orig_l"] and q.newlines == nl == q.newline
+            q.buffer[1] = K["new"]
+            q.append(K["last"])
+            q.quit(backup=K["bkup"])
+            assert td.filename.read_binary() == written_format(
+                K["orig_l"][:1] + [K["new"]] + K["orig_l"][2:] + [K["last"]],
+                nl).encode()
+            td.filename.write_binary(written_format(K["orig_l"], nl).encode())
+    for nl in [K["lf"], K["crlf"]]:
+        td.filename.write_binary(written_format(K["orig_l"], nl).encode())
+        q = editor.editor(td.basename, storage=K["mmap"])
+        assert q.newlines == nl
+        q.append(K["last"])
+        q.quit(backup=K["bkup"])
+        q = editor.editor(td.basename, stream=True)
+        assert q.newlines == nl
+        q.sub(K["stst"], K["that"])
+        q.quit(backup=K["bkup"])
+        assert td.filename.read_binary() == written_format(
+            [x.replace(K["stst"], K["that"]) for x in K["orig_l"]] +
+            [K["last"]], nl).encode()
+        q = editor.editor(td.basename, binary=True)
+        assert q.newlines == nl.encode()
+
+    mixed = (K["orig_l"][0] + K["crlf"] + K["orig_l"][1] + K["cr"] +
+             written_format(K["orig_l"][2:])).encode()
+    td.filename.write_binary(mixed)
+    q = editor.editor(td.basename)
+    assert q.buffer == K["orig_l"]
+    with open(td.basename, newline=None) as f:
+        f.read()
+        assert q.newlines == f.newlines == (K["cr"], K["lf"], K["crlf"])
+    assert not q.quit()
+    assert td.filename.read_binary() == mixed
+    q = editor.editor(td.basename, binary=True)
+    assert q.newlines == (K["lf"].encode(), K["crlf"].encode())
+    assert q.newline == K["lf"].encode()
+    assert editor.editor.contents(td.basename) == K["orig_l"]
+
+
 # -----------------------------------------------------------------------------
 def test_newfile(tmpdir):
     """
@@ -522,6 +1429,38 @@ def test_overwrite_recovery(tmpdir, td):
     assert written_format(K["orig_l"]) == td.filename.read()
 
 
+# -----------------------------------------------------------------------------
+def test_parallel(tmpdir, monkeypatch):
+    """
+    Verify that sub() and delete() with workers give the same results as
+    without, on the buffer and in stream mode
+    """
+    pytest.debug_func()
+    monkeypatch.setattr(editor.editor, 'chunk_bytes', 1000)
+    data = [K["nfmt"].format(_) + K["stst"] for _ in range(3000)]
+    for storage in ['list', K["chnk"]]:
+        q = editor.editor(content=list(data), storage=storage)
+        r = editor.editor(content=list(data), storage=storage)
+        assert q.sub(K["wend"][:-1] + "3", K["that"], workers=2) == \
+            r.sub(K["wend"][:-1] + "3", K["that"])
+        assert q.delete(K["wend"][:-1] + "1", workers=3) == \
+            r.delete(K["wend"][:-1] + "1")
+        assert q.buffer == r.buffer and isinstance(q.buffer, type(r.buffer))
+
+    src = tmpdir.join(K["bigf"])
+    src.write(written_format(data, K["crlf"]))
+    expected = []
+    for workers in [None, 3]:
+        for tail in [[], [("insert", K["new"], 5)]]:
+            q = editor.editor(src.strpath, stream=True)
+            q.sub(K["stst"], K["that"], workers=workers)
+            q.delete(K["wend"][:-1] + "7")
+            apply_script(q, tail + [("append", K["last"])])
+            q.quit(filepath=tmpdir.join(K["altfile"]).strpath)
+            expected.append(tmpdir.join(K["altfile"]).read())
+    assert expected[0] == expected[2] and expected[1] == expected[3]
+
+
 # -----------------------------------------------------------------------------
 def test_qbackup(tmpdir, td, backup_reset):
     """
@@ -534,11 +1473,133 @@ def test_qbackup(tmpdir, td, backup_reset):
     except AttributeError:
         pass
     q = editor.editor(td.filename.strpath, backup=squawker)
+    q.insert(K["new"])
     q.quit(backup=altbackup)
     assert not hasattr(squawker, K['called'])
     assert hasattr(altbackup, K['called']) and altbackup.called
 
 
+# -----------------------------------------------------------------------------
+def test_save_memory(tmpdir, monkeypatch):
+    """
+    Verify that saving a buffer writes it a block at a time rather than
+    making a copy of every line
+    """
+    pytest.debug_func()
+    monkeypatch.setattr(editor.editor, 'write_size', 1000)
+    big = tmpdir.join(K["bigf"])
+    for storage in ['list', K["chnk"]]:
+        big.write(written_format(K["orig_l"] * 25000))
+        q = editor.editor(big.strpath, storage=storage)
+        q.sub(K["lowe"], K["uppE"])
+        tracemalloc.start()
+        assert q.quit()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        assert peak < big.size() // 20
+    exp = written_format([_.replace(K["lowe"], K["uppE"])
+                          for _ in K["orig_l"]] * 25000)
+    assert exp == big.read()
+
+
+# -----------------------------------------------------------------------------
+def test_snapshot():
+    """
+    Verify that a snapshot() is left alone by later edits, shares the
+    chunks those edits don't touch, reports the changed ranges through
+    diff(), and can be restored, and the restore undone, more than once
+    """
+    pytest.debug_func()
+    lines = [K["nfmt"].format(_) for _ in range(5000)]
+    for storage in ['list', K["chnk"], K["cmpt"]]:
+        q = editor.editor(content=lines[:], storage=storage,
+                          undo_limit=1)
+        snap = q.snapshot()
+        assert q.diff(snap) == []
+        assert q.sub("^0001[01]", K["frib"]) == 20
+        assert q.diff(snap) == [(100, 120, 100, 120)]
+        q.insert(K["new"], 3000)
+        i1, i2, j1, j2 = q.diff(snap)[-1]
+        assert j1 <= 3000 < j2 and (j2 - j1) - (i2 - i1) == 1
+        assert list(snap) == lines
+        q.restore(snap)
+        assert list(q.buffer) == lines and q.diff(snap) == []
+        assert q.undo()
+        assert q.buffer[3000] == K["new"]
+        q.restore(snap)
+        assert list(q.buffer) == lines
+
+    q = editor.editor(content=lines[:], storage=K["chnk"])
+    snap = q.snapshot()
+    q.sub("^00042", K["frib"])
+    q.delete("^00040")
+    q.append(K["new"])
+    shared = set(map(id, snap._chunks)) & set(map(id, q.buffer._chunks))
+    assert len(shared) == len(snap._chunks) - 2
+    assert q.diff(snap) == [(400, 430, 400, 420), (5000, 5000, 4990, 4991)]
+    assert list(snap) == lines
+
+    q = editor.editor(content=[], stream=True)
+    with pytest.raises(editor.Error):
+        q.snapshot()
+
+
+# -----------------------------------------------------------------------------
+def test_stream(tmpdir, td):
+    """
+    Verify that stream mode applies sub, delete, append, and insert in the
+    order they were called and writes the same result that editing the
+    buffer in memory would, to an existing file or a new one, which gets
+    the mode the umask allows.
+    """
+    pytest.debug_func()
+    q = editor.editor(content=K["orig_l"][:])
+    s = editor.editor(td.filename.strpath, stream=True)
+    assert s.buffer is None
+    for ed in [q, s]:
+        apply_script(ed, K["script"])
+    s.quit()
+    backup = py.path.local(s.backup_filename())
+    assert written_format(K["orig_l"]) == backup.read()
+    assert written_format(q.buffer) == td.filename.read()
+    with pytest.raises(editor.Error) as err:
+        len(s)
+    assert K["strm"] in str(err)
+
+    newfile = tmpdir.join(K["nwfl"])
+    umask = os.umask(0o022)
+    try:
+        s = editor.editor(newfile.strpath, content=K["orig_l"][:],
+                          stream=True)
+        apply_script(s, K["script"])
+        assert s.quit()
+    finally:
+        os.umask(umask)
+    assert written_format(q.buffer) == newfile.read()
+    assert newfile.stat().mode & 0o777 == 0o644
+
+
+# -----------------------------------------------------------------------------
+def test_stream_memory(tmpdir):
+    """
+    Verify that the memory used to save in stream mode does not depend on
+    the size of the file
+    """
+    pytest.debug_func()
+    big = tmpdir.join(K["bigf"])
+    big.write(written_format(K["orig_l"] * 25000))
+    tracemalloc.start()
+    q = editor.editor(big.strpath, stream=True)
+    q.sub(K["lowe"], K["uppE"])
+    q.quit()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    assert peak < big.size() // 20
+    exp = written_format([_.replace(K["lowe"], K["uppE"])
+                          for _ in K["orig_l"]] * 25000)
+    assert exp == big.read()
+
+
 # -----------------------------------------------------------------------------
 def test_substitute(tmpdir, td):
     """
@@ -560,6 +1621,93 @@ def test_substitute(tmpdir, td):
     assert exp == td.filename.read()
 
 
+# -----------------------------------------------------------------------------
+def test_substitute_many():
+    """
+    Verify that sub_many() applies all its patterns in one scan, with the
+    earlier pattern winning where two match at the same spot, and keeps the
+    flags of compiled patterns
+    """
+    pytest.debug_func()
+    q = editor.editor(content=K["orig_l"][:])
+    pairs = [(K["test"], K["frib"]),
+             (K["lowe"], K["uppE"]),
+             (re.compile(K["this"], re.IGNORECASE), K["that"])]
+    assert q.sub_many(pairs) == len(K["orig_l"])
+
+    def expected(match):
+        if match.group() == K["test"]:
+            return K["frib"]
+        elif match.group() == K["lowe"]:
+            return K["uppE"]
+        return K["that"]
+    rgx = "|".join([K["test"], K["lowe"], "(?i:" + K["this"] + ")"])
+    assert q.buffer == [re.sub(rgx, expected, _) for _ in K["orig_l"]]
+
+    r = editor.editor(content=K["orig_l"][:])
+    r.sub_many({K["dot"]: K["bang"]}, literal=True)
+    assert r.buffer[-1].endswith(K["bang"])
+    assert r.buffer[:-1] == K["orig_l"][:-1]
+
+
+# -----------------------------------------------------------------------------
+def test_substitute_literal(tmpdir):
+    """
+    Verify that literal=True makes sub() and delete() treat regex
+    metacharacters as plain text, and that patterns with no metacharacters
+    give the same result either way, and that a callable replacement gets
+    the regex engine's match objects
+    """
+    pytest.debug_func()
+    q = editor.editor(content=K["orig_l"][:])
+    q.sub(K["dot"], K["bang"], literal=True)
+    assert q.buffer == [_.replace(K["dot"], K["bang"]) for _ in K["orig_l"]]
+    r = editor.editor(content=q.buffer[:])
+    q.sub(K["lowa"], K["uppA"], 1)
+    r.sub(K["lowa"], K["uppA"], 1, literal=False)
+    assert q.buffer == r.buffer
+    last = q.buffer[-1]
+    assert q.delete(K["bang"], literal=True) == [last]
+    assert q.delete(K["dot"], literal=True) == []
+    assert len(q) == 3
+
+    exp = [_.replace(K["lowa"], K["uppA"]) for _ in K["orig_l"]]
+    for kwargs in [{}, {'joined': True}]:
+        q = editor.editor(content=K["orig_l"][:])
+        q.sub(K["lowa"], lambda m: m.group().upper(), **kwargs)
+        assert q.buffer == exp
+    q = editor.editor(content=K["orig_l"][:])
+    with q.batch():
+        q.sub(K["lowa"], lambda m: m.group().upper())
+    assert q.buffer == exp
+    src = tmpdir.join(K["nwfl"])
+    src.write(written_format(K["orig_l"]))
+    q = editor.editor(src.strpath, stream=True)
+    q.sub(K["lowa"], lambda m: m.group().upper())
+    q.quit()
+    assert src.read() == written_format(exp)
+
+
+# -----------------------------------------------------------------------------
+def test_substitute_joined():
+    """
+    Verify that sub(joined=True) gives the same buffer as the line by line
+    substitution, that both report the number of lines changed, and that a
+    pattern which matches across lines is refused
+    """
+    pytest.debug_func()
+    q = editor.editor(content=K["orig_l"][:])
+    r = editor.editor(content=K["orig_l"][:])
+    with pytest.raises(editor.Error):
+        r.sub(K["xline"], K["frib"], joined=True)
+    assert r.buffer == K["orig_l"]
+    assert q.sub(K["wend"], K["uppE"]) == 1
+    assert r.sub(K["wend"], K["uppE"], joined=True) == 1
+    assert q.buffer == r.buffer
+    assert r.sub(K["test"], K["frib"], joined=True) == 2
+    assert r.sub(K["lowa"], K["uppA"], joined=True, literal=False) == 3
+
+
 # -----------------------------------------------------------------------------
 def test_substitute_limit(tmpdir, td):
     """
@@ -591,6 +1739,161 @@ def test_trailing_whitespace(tmpdir, td):
     assert K["orig_l"] == q.buffer
 
 
+# -----------------------------------------------------------------------------
+def test_unchanged(tmpdir, td, fx_chdir):
+    """
+    Verify that quit() neither backs up nor writes a file whose content
+    would not change, and reports whether it wrote
+    """
+    pytest.debug_func()
+    mtime = td.filename.stat().mtime_ns
+    for storage in ['list', K["chnk"], K["cmpt"], K["mmap"]]:
+        q = editor.editor(td.basename, storage=storage)
+        assert q.sub(K["nosuch"], K["new"]) == 0
+        assert not q.changed()
+        assert not q.quit()
+        glob_assert("*", 1)
+        assert td.filename.stat().mtime_ns == mtime
+    q = editor.editor(td.basename)
+    q.sub(K["lowe"], K["lowe"])
+    q.insert(K["new"])
+    assert q.changed()
+    del q.buffer[0]
+    assert not q.changed()
+    q.buffer[0] = K["new"]
+    assert q.changed()
+    assert q.quit()
+    glob_assert("*", 2)
+
+
+# -----------------------------------------------------------------------------
+def test_unchanged_crlf(tmpdir, td, fx_chdir):
+    """
+    Verify that an unchanged buffer is still written when the file's line
+    terminators differ from the ones quit() would write, even when the file
+    keeps its size, as with mixed terminators or no final newline
+    """
+    pytest.debug_func()
+    td.filename.write(written_format(K["orig_l"], K["crlf"]))
+    for storage in ['list', K["mmap"]]:
+        q = editor.editor(td.basename, storage=storage, backup=K["bkup"])
+        assert not q.changed()
+        assert not q.quit(newline=K["crlf"])
+        glob_assert("*", 1)
+    q = editor.editor(td.basename, storage=K["mmap"], backup=K["bkup"],
+                      newline="\n")
+    assert q.quit()
+    glob_assert("*", 2)
+    assert td.filename.read_binary() == written_format(K["orig_l"]).encode()
+    mixed = (K["orig_l"][0] + K["crlf"] + K["orig_l"][1] + K["lf"] +
+             K["orig_l"][2])
+    for data, nl in [(mixed, K["lf"]),
+                     (written_format(K["orig_l"], K["crlf"])[:-2], K["crlf"])]:
+        for kw in [{'newline': nl}, {}]:
+            td.filename.write_binary(data.encode())
+            q = editor.editor(td.basename, **kw)
+            assert q.quit(newline=nl)
+            assert td.filename.read_binary() == written_format(
+                data.replace(K["crlf"], K["lf"]).split(K["lf"]), nl).encode()
+    q = editor.editor(td.basename, stream=True)
+    assert not q.changed()
+    q.append(K["new"])
+    assert q.changed()
+
+
+# -----------------------------------------------------------------------------
+def test_undo():
+    """
+    Verify that undo() takes back each kind of change in turn, that redo()
+    makes them again, that a new change clears redo(), that a sub()
+    touching a few lines of a large buffer records just those lines, and
+    that the journal is off by default and keeps at most undo_limit changes
+    """
+    pytest.debug_func()
+    for storage in ['list', K["chnk"], K["cmpt"]]:
+        q = editor.editor(content=K["orig_l"][:], storage=storage,
+                          undo_limit=20)
+        assert not q.undo()
+        states = [list(q.buffer)]
+        q.sub(K["lowe"], K["uppE"])
+        states.append(list(q.buffer))
+        q.delete(K["lowa"])
+        states.append(list(q.buffer))
+        q.append(K["after"])
+        states.append(list(q.buffer))
+        q.insert(K["before"], -1)
+        states.append(list(q.buffer))
+        with q.batch():
+            q.insert(K["middle"], 2)
+            q.sub_many({K["bang"]: K["dot"]})
+        states.append(list(q.buffer))
+        assert q.sub(K["nosuch"], K["one"]) == 0
+        done = states[:]
+        while q.undo():
+            states.pop()
+            assert list(q.buffer) == states[-1]
+        assert len(states) == 1
+        q.redo()
+        q.redo()
+        assert list(q.buffer) == done[2]
+        q.append(K["new"])
+        assert not q.redo()
+        assert q.undo() and q.undo() and q.undo() and not q.undo()
+        assert list(q.buffer) == K["orig_l"]
+
+    lines = [K["nfmt"].format(_) for _ in range(100000)]
+    q = editor.editor(content=lines[:], undo_limit=20)
+    assert q.sub("^0001", K["frib"]) == 100
+    entry = q._undo[-1]
+    assert entry[0] == "set" and len(entry[1]) == len(entry[2]) == 100
+    assert len(q.delete(K["frib"])) == 100
+    assert len(q.delete("5$")) == 9990
+    assert len(q.delete(K["nfmt"].format(77777))) == 1
+    q.undo()
+    q.undo()
+    q.undo()
+    q.undo()
+    assert q.buffer == lines
+    q.redo()
+    q.redo()
+    q.redo()
+    assert len(q) == 100000 - 100 - 9990
+
+    q = editor.editor(content=K["orig_l"][:], undo_limit=20)
+    steps = [lambda: q.sub(K["lowe"], K["uppE"])]
+    steps += [functools.partial(q.append, _)
+              for _ in [K["one"], K["two"], K["frib"], K["last"]]]
+    steps += [lambda: q.sub(K["last"], K["frst"]),
+              lambda: q.restore(q.snapshot()[:2]),
+              lambda: q.insert(K["new"], 1)]
+    states = [list(q.buffer)]
+    for step in steps:
+        step()
+        states.append(list(q.buffer))
+    for _ in range(2):
+        for state in reversed(states[:-1]):
+            assert q.undo() and list(q.buffer) == state
+        assert not q.undo()
+        for state in states[1:]:
+            assert q.redo() and list(q.buffer) == state
+        assert not q.redo()
+
+    q = editor.editor(content=K["orig_l"][:])
+    q.sub(K["lowe"], K["uppE"])
+    assert not q.undo() and q._undo == []
+    q.undo_limit = 2
+    for line in [K["one"], K["two"], K["frib"]]:
+        q.append(line)
+    assert q.undo() and q.undo() and not q.undo()
+    assert q.buffer[-1] == K["one"]
+    with q.batch():
+        with pytest.raises(editor.Error):
+            q.undo()
+    q = editor.editor(content=[], stream=True)
+    with pytest.raises(editor.Error):
+        q.undo()
+
+
 # -----------------------------------------------------------------------------
 def test_version():
     """
@@ -630,6 +1933,15 @@ def alt_backup(ext):
     open(filename, 'w').close()
 
 
+# -----------------------------------------------------------------------------
+def apply_script(ed, script):
+    """
+    Call the editor methods named in *script* on *ed*, in order
+    """
+    for step in script:
+        getattr(ed, step[0])(*step[1:])
+
+
 # -----------------------------------------------------------------------------
 def contents(path):
     """
@@ -662,7 +1974,8 @@ def squawker(filepath):
 # -----------------------------------------------------------------------------
 def written_format(lines, newline="\n"):
     """
-    Concatenate *lines* with *newline* separators as if written in a file
+    Concatenate *lines* with *newline* separators as if written in a file.
+    *lines* and *newline* may be bytes.
     """
     return newline.join(lines) + newline
 